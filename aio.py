@@ -0,0 +1,66 @@
+import asyncio
+import functools
+import time
+from contextvars import ContextVar
+from sqlalchemy.util import await_only, greenlet_spawn
+
+'''
+helpers for running the (sync) flask app on an asyncio event loop
+
+    the ASGI mode runs each request in a greenlet started by spawn().
+    code in that greenlet is written as usual, but whenever it waits on the
+    database (through an asyncio driver, see model.setup_for_db) or on
+    run_blocking, the greenlet is suspended and the event loop serves other
+    requests meanwhile. outside of spawn() every helper behaves like the
+    plain sync call, so the same code runs under gunicorn's sync workers.
+'''
+
+_on_event_loop = ContextVar('on_event_loop', default=False)
+
+
+def on_event_loop():
+    return _on_event_loop.get()
+
+
+async def spawn(fn, *args, **kwargs):
+    """Runs the sync callable `fn` in a greenlet on the running event loop
+    """
+    token = _on_event_loop.set(True)
+    try:
+        return await greenlet_spawn(fn, *args, **kwargs)
+    finally:
+        _on_event_loop.reset(token)
+
+
+def run_blocking(fn, *args):
+    """Calls `fn`, in a worker thread when on the event loop so it is not blocked
+    """
+    if not on_event_loop():
+        return fn(*args)
+    loop = asyncio.get_event_loop()
+    return await_only(loop.run_in_executor(None, functools.partial(fn, *args)))
+
+
+def acquire(lock, blocking=True, poll_interval=0.005):
+    """threading.Lock.acquire that yields to the event loop while waiting
+
+    greenlets share their thread, so blocking on a lock held by another
+    greenlet of the same loop would never return
+    """
+    if not on_event_loop():
+        return lock.acquire(blocking)
+
+    while not lock.acquire(False):
+        if not blocking:
+            return False
+        await_only(asyncio.sleep(poll_interval))
+    return True
+
+
+def sleep(seconds):
+    """time.sleep that yields to the event loop while waiting
+    """
+    if not on_event_loop():
+        time.sleep(seconds)
+        return
+    await_only(asyncio.sleep(seconds))
@@ -0,0 +1,224 @@
+import io
+import logging
+import sys
+from flask import Response
+from sqlalchemy.util import await_only
+
+import aio
+from auth import AuthError, get_key_store
+from main import create_app
+from model import db
+from serializers import dumps
+
+logger = logging.getLogger(__name__)
+
+'''
+asgi_environ(scope, body)
+    the WSGI environ for an ASGI http scope and its (fully read) request body
+'''
+
+
+def asgi_environ(scope, body):
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH' or name == 'CONTENT_TYPE':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+
+    # the body is already read in full (chunked requests included)
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+'''
+AsgiApp
+    serves the flask app built by `factory` (see main.create_app) over ASGI
+
+    the app is built on startup, and every request runs the same flask routes
+    in a greenlet on the event loop (see aio). with async_driver=True the
+    database driver is asyncpg, so a request waiting on RDS or on the Auth0
+    key set lets the worker serve other requests in the meantime.
+    response bodies are sent chunk by chunk, streamed exports included.
+
+    run it with: gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+'''
+
+
+class AsgiApp:
+    def __init__(self, factory):
+        self.factory = factory
+        self.flask_app = None
+
+    def get_flask_app(self):
+        if self.flask_app is None:
+            self.flask_app = self.factory()
+        return self.flask_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            body = await _read_body(receive)
+            await aio.spawn(self.handle, scope, body, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope: {scope["type"]}')
+
+    def handle(self, scope, body, send):
+        flask_app = self.get_flask_app()
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+
+        result = flask_app(asgi_environ(scope, body), start_response)
+        try:
+            status, headers = started
+            await_only(send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers]
+            }))
+            for chunk in result:
+                if chunk:
+                    await_only(send({'type': 'http.response.body',
+                                     'body': chunk, 'more_body': True}))
+            await_only(send({'type': 'http.response.body', 'body': b''}))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def startup(self):
+        self.get_flask_app()
+        try:
+            # fetch the signing keys before the first request needs them
+            get_key_store().refresh()
+        except AuthError:
+            logger.warning('Unable to fetch the JWKS on startup')
+
+    def shutdown(self):
+        if self.flask_app is not None:
+            with self.flask_app.app_context():
+                db.engine.dispose()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await aio.spawn(self.startup)
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await aio.spawn(self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+class AsgiClient:
+    """The subset of flask's test client used by test_app.py and benchmarks/,
+    sending requests through an AsgiApp (from a greenlet started by aio.spawn)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def open(self, method, path, json=None, data=None, content_type=None, headers=None):
+        path, _, query = path.partition('?')
+        body = b''
+        headers = dict(headers or {})
+        if json is not None:
+            body = dumps(json)
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = data.encode('utf-8') if isinstance(data, str) else data
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'query_string': query.encode('latin-1'),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers.items()],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        await_only(self.app(scope, receive, send))
+        start = messages[0]
+        return Response(b''.join(message.get('body', b'') for message in messages[1:]),
+                        status=start['status'],
+                        headers=[(name.decode('latin-1'), value.decode('latin-1'))
+                                 for name, value in start['headers']])
+
+    def get(self, path, **kwargs):
+        return self.open('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open('DELETE', path, **kwargs)
+
+    def options(self, path, **kwargs):
+        return self.open('OPTIONS', path, **kwargs)
+
+
+def create_asgi_app():
+    return AsgiApp(lambda: create_app(async_driver=True))
+
+
+app = create_asgi_app()
@@ -1,13 +1,29 @@
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 from flask import request
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 import os
 
+import aio
+from metrics import record_auth
+from ratelimit import limit
+
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_ENABLED = os.environ.get(
+    'TOKEN_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 # AuthError Exception
 
@@ -52,6 +68,137 @@ def get_token_auth_header():
     return token
 
 
+'''
+JWKSKeyStore
+    in-process cache of the Auth0 JSON Web Key Set
+
+    keys are indexed by kid once per fetch and kept for `ttl` seconds.
+    an unknown kid triggers a refresh (at most once per `min_refresh_interval`
+    seconds), and concurrent callers share a single in-flight fetch.
+    when a refresh fails the previously fetched keys keep being served.
+
+    `url` may be any url understood by urlopen (https://, http:// or file://),
+    or `fetch` may be given as a callable returning the decoded jwks document.
+    in the ASGI mode the fetch runs in a worker thread, so waiting on Auth0
+    does not hold up the event loop.
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, url=JWKS_URL, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT, fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._fetch = fetch or self._fetch_url
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.fetch_errors = 0
+
+    def _fetch_url(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def _can_attempt(self, now, min_interval):
+        return (self._last_attempt is None
+                or now - self._last_attempt >= min_interval)
+
+    def is_stale(self):
+        if self._fetched_at is None:
+            return True
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    def refresh(self, min_interval=0, blocking=True):
+        """Fetches the key set unless another caller already did so
+        """
+        generation = self._generation
+        if not aio.acquire(self._lock, blocking):
+            # someone else is refreshing, keep serving what we have
+            return
+        try:
+            if self._generation != generation:
+                return
+
+            now = time.monotonic()
+            if not self._can_attempt(now, min_interval):
+                return
+            self._last_attempt = now
+
+            self.fetches += 1
+            try:
+                jwks = aio.run_blocking(self._fetch)
+            except Exception:
+                self.fetch_errors += 1
+                if self._keys:
+                    return
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch signing keys.'
+                }, 503)
+
+            self._keys = {key['kid']: key
+                          for key in jwks.get('keys', []) if 'kid' in key}
+            self._fetched_at = now
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+    def get_key(self, kid):
+        if self.is_stale():
+            now = time.monotonic()
+            if not self._keys:
+                self.refresh()
+            elif self._can_attempt(now, self.min_refresh_interval):
+                self.refresh(self.min_refresh_interval, blocking=False)
+
+        key = self._keys.get(kid)
+        if key is None:
+            self.refresh(self.min_refresh_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def stats(self):
+        return {
+            'keys': len(self._keys),
+            'age_seconds': round(time.monotonic() - self._fetched_at, 3)
+            if self._fetched_at is not None else -1,
+            'stale': self.is_stale(),
+            'fetches': self.fetches,
+            'fetch_errors': self.fetch_errors
+        }
+
+    def clear(self):
+        aio.acquire(self._lock)
+        try:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+
+key_store = JWKSKeyStore()
+
+
+def get_key_store():
+    return key_store
+
+
+def set_key_store(store):
+    """Replaces the process-wide key store (e.g. with one reading a local file)
+    """
+    global key_store
+    key_store = store
+    return store
+
+
 '''
     Implement check_permissions(permission, payload) method
     @INPUTS
@@ -65,14 +212,23 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
+def permission_set(payload):
     if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
+
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        permissions = permission_set(payload)
+
+    if permissions is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found'
@@ -87,6 +243,7 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        (served from the cached key store, see JWKSKeyStore)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -96,8 +253,6 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -106,15 +261,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = get_key_store().get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
 
     if rsa_key:
         try:
@@ -150,14 +305,115 @@ def verify_decode_jwt(token):
     }, 403)
 
 
+'''
+VerifiedTokenCache
+    bounded LRU of already verified token payloads
+
+    entries are keyed by the sha256 digest of the raw token (the token itself
+    is never stored) and are dropped once the token's `exp` claim has passed.
+    tokens without an `exp` claim are not cached.
+'''
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, enabled=TOKEN_CACHE_ENABLED):
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """Returns (payload, permissions) for a cached token or None
+        """
+        if not self.enabled:
+            return None
+
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[digest]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, token, payload):
+        permissions = permission_set(payload)
+        if not self.enabled or not isinstance(payload.get('exp'), (int, float)):
+            return permissions
+
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (payload['exp'], payload, permissions)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+token_cache = VerifiedTokenCache()
+
+
+def _verify_token(token):
+    # the third value says how the token was verified (see metrics.record_auth)
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached + ('cache',)
+
+    store = get_key_store()
+    fetches = store.fetches
+    payload = verify_decode_jwt(token)
+    source = 'jwks_fetch' if store.fetches != fetches else 'jwks'
+    return payload, token_cache.set(token, payload), source
+
+
+def decode_verified_token(token):
+    """Returns (payload, permissions), verifying the token only on a cache miss
+    """
+    payload, permissions, _ = _verify_token(token)
+    return payload, permissions
+
+
 '''
     Implement @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:movies')
+        permission: string permission (i.e. 'post:movies'), or a function of the
+            view's arguments returning it, called once the token is verified
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        (through decode_verified_token, so repeated tokens skip verification,
+        and timed for the metrics and Server-Timing header)
     it should use the check_permissions method validate claims and check the requested permission
+    it should apply the client's rate limit for the permission, and shed write
+        requests while the database is overloaded (see ratelimit.limit)
     return the decorator which passes the decoded payload to the decorated method
 '''
 
@@ -167,9 +423,17 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                payload, permissions, source = _verify_token(token)
+            except AuthError:
+                record_auth(time.perf_counter() - start, 'rejected')
+                raise
+            record_auth(time.perf_counter() - start, source)
+            required = permission(**kwargs) if callable(permission) else permission
+            check_permissions(required, payload, permissions)
+            with limit(required, payload):
+                return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
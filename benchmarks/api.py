@@ -0,0 +1,285 @@
+'''
+API benchmark
+    measures latency and throughput of the API endpoints, in process
+
+    create_app runs against a local database (a temporary sqlite file unless
+    --database-url points at a local postgres) seeded with --movies movies
+    and --actors actors. requests carry RS256 tokens signed with a key
+    generated for the run, verified against a JWKS file served through
+    JWKS_URL=file://, so no Auth0 tenant or RDS instance is needed.
+
+    every endpoint gets --requests requests from --concurrency clients, and
+    its p50/p95/p99 latency and requests/sec are reported. with --mode asgi
+    the requests go through asgi.AsgiApp and the async driver instead.
+
+    usage: python -m benchmarks.api [--movies N] [--actors N] [--requests N]
+        [--concurrency N] [--mode wsgi|asgi] [--database-url URL]
+        [--no-response-cache] [--output results.json]
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+PERMISSIONS = [
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies',
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors'
+]
+AUTH0_DOMAIN = 'benchmark.local'
+API_AUDIENCE = 'benchmark'
+KEY_ID = 'benchmark'
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+'''
+LocalSigner
+    an RS256 key pair standing in for the Auth0 tenant
+
+    jwks() is the key set Auth0 would publish, token() signs an access token
+    with the claims the API checks (iss, aud, exp, permissions)
+'''
+
+
+class LocalSigner:
+    def __init__(self, kid=KEY_ID):
+        from Crypto.PublicKey import RSA
+        self.kid = kid
+        self.key = RSA.generate(2048)
+
+    def jwks(self):
+        return {'keys': [{
+            'kid': self.kid,
+            'kty': 'RSA',
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64(self.key.n),
+            'e': _b64(self.key.e)
+        }]}
+
+    def token(self, permissions=PERMISSIONS, sub='auth0|benchmark', ttl=3600):
+        from jose import jwt
+        claims = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'aud': API_AUDIENCE,
+            'sub': sub,
+            'azp': 'benchmark',
+            'exp': int(time.time()) + ttl,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.key.exportKey('PEM').decode('ascii'),
+                          algorithm='RS256', headers={'kid': self.kid})
+
+
+def _configure_environment(args, directory, signer):
+    # read by the app modules when they are imported, so set before that
+    jwks_path = os.path.join(directory, 'jwks.json')
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump(signer.jwks(), jwks_file)
+
+    os.environ.update({
+        'DATABASE_URL': args.database_url or
+        'sqlite:///' + os.path.join(directory, 'benchmark.db'),
+        'AUTH0_DOMAIN': AUTH0_DOMAIN,
+        'API_AUDIENCE': API_AUDIENCE,
+        'ALGORITHMS': 'RS256',
+        'JWKS_URL': 'file://' + jwks_path,
+    })
+    # one client sends every request, its quota would cap the write endpoints
+    os.environ['RATE_LIMIT_ENABLED'] = 'false'
+    if args.no_response_cache:
+        os.environ['RESPONSE_CACHE_ENABLED'] = 'false'
+
+
+def seed(movies, actors):
+    """Fills an empty database with `movies` movies and `actors` actors
+    """
+    from model import db, Movie, Actor
+
+    if db.session.query(Movie.id).first() is not None:
+        return
+    start = date(1990, 1, 1)
+    for offset in range(0, movies, 1000):
+        Movie.bulk_insert([{'title': f'Movie {i}',
+                            'release_date': start + timedelta(days=i % 12000)}
+                           for i in range(offset, min(offset + 1000, movies))])
+    for offset in range(0, actors, 1000):
+        Actor.bulk_insert([{'name': f'Actor {i}', 'age': 18 + i % 60,
+                            'gender': ('female', 'male')[i % 2],
+                            'movie_id': 1 + i % movies if movies else None}
+                           for i in range(offset, min(offset + 1000, actors))])
+    db.session.commit()
+
+
+def endpoints(args):
+    """(name, method, path, body) of every benchmarked request
+    """
+    movie_id = max(1, args.movies // 2)
+    actor_id = max(1, args.actors // 2)
+    return [
+        ('status', 'GET', '/status', None),
+        ('list movies', 'GET', '/movies', None),
+        ('list movies by release date', 'GET',
+         '/movies?order=release_date&limit=100', None),
+        ('search movies', 'GET', '/movies?title_prefix=Movie%201', None),
+        ('list actors of a movie', 'GET', f'/actors?movie_id={movie_id}', None),
+        ('get movie with actors', 'GET',
+         f'/movies/{movie_id}?include=actors', None),
+        ('get actor', 'GET', f'/actors/{actor_id}', None),
+        ('create movie', 'POST', '/movies',
+         {'title': 'Benchmark', 'release_date': '2020-01-01'}),
+        ('update actor', 'PATCH', f'/actors/{actor_id}',
+         {'name': f'Actor {actor_id}', 'age': 42, 'gender': 'female',
+          'movie_id': movie_id}),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def summarize(name, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'endpoint': name,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def _run_wsgi(app, requests, concurrency, headers):
+    local = threading.local()
+
+    def send(request):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        method, path, body = request
+        start = time.perf_counter()
+        res = client.open(path, method=method, json=body, headers=headers)
+        return time.perf_counter() - start, res.status_code
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(send, requests))
+        return results, time.perf_counter() - start
+
+
+def _run_asgi(app, requests, concurrency, headers):
+    import aio
+    from asgi import AsgiApp, AsgiClient
+
+    client = AsgiClient(AsgiApp(lambda: app))
+
+    def send(request):
+        method, path, body = request
+        start = time.perf_counter()
+        res = client.open(method, path, json=body, headers=headers)
+        return time.perf_counter() - start, res.status_code
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(request):
+            async with semaphore:
+                return await aio.spawn(send, request)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[bounded(request) for request in requests])
+        return results, time.perf_counter() - start
+
+    return asyncio.get_event_loop().run_until_complete(main())
+
+
+def run(args):
+    directory = tempfile.mkdtemp()
+    signer = LocalSigner()
+    _configure_environment(args, directory, signer)
+
+    import aio
+    from main import create_app
+    from model import upgrade_schema
+
+    asgi = args.mode == 'asgi'
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def build():
+        app = create_app(async_driver=asgi)
+        upgrade_schema(app)
+        with app.app_context():
+            seed(args.movies, args.actors)
+        return app
+
+    app = loop.run_until_complete(aio.spawn(build)) if asgi else build()
+    headers = {'Authorization': 'Bearer ' + signer.token()}
+    send_all = _run_asgi if asgi else _run_wsgi
+
+    results = []
+    for name, method, path, body in endpoints(args):
+        requests = [(method, path, body)] * args.requests
+        # warm up connections, caches and the key store first
+        send_all(app, requests[:args.concurrency], args.concurrency, headers)
+        timings, elapsed = send_all(app, requests, args.concurrency, headers)
+        errors = sum(1 for _, status in timings if status >= 400)
+        results.append(summarize(name, [latency for latency, _ in timings],
+                                 errors, elapsed))
+    return results
+
+
+def report(args, results):
+    print(f'{args.mode}, {args.movies} movies, {args.actors} actors, '
+          f'{args.requests} requests per endpoint, concurrency {args.concurrency}')
+    print(f'{"endpoint":<30} {"rps":>9} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"errors":>7}')
+    for result in results:
+        print(f'{result["endpoint"]:<30} {result["rps"]:>9} '
+              f'{result["p50_ms"]:>9} {result["p95_ms"]:>9} '
+              f'{result["p99_ms"]:>9} {result["errors"]:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API latency/throughput benchmark')
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--actors', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--database-url', default=None,
+                        help='a local database to use instead of a temporary '
+                             'sqlite file, seeded when empty')
+    parser.add_argument('--no-response-cache', action='store_true')
+    parser.add_argument('--output', default=None,
+                        help='also write the results to this file as json')
+    args = parser.parse_args()
+
+    results = run(args)
+    report(args, results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'mode': args.mode, 'movies': args.movies,
+                       'actors': args.actors, 'requests': args.requests,
+                       'concurrency': args.concurrency, 'results': results},
+                      output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+serialization benchmark
+    compares the two ways a page of movies can be turned into a response:
+
+    orm: full Movie objects, Movie.format() per row, then flask.jsonify
+    columns: column tuples from query.with_entities, serializers.dumps
+        (with the stdlib encoder and, when installed, orjson)
+
+    runs against a throwaway sqlite database, so it measures the python side
+    only. usage: python -m benchmarks.serialization [--rows N] [--repeat N]
+'''
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+from flask import Flask, jsonify
+
+import serializers
+from model import setup_for_db, upgrade_schema, db, Movie
+
+
+def _seed(rows):
+    start = date(2000, 1, 1)
+    Movie.bulk_insert([{'title': f'movie {i}',
+                        'release_date': start + timedelta(days=i % 5000)}
+                       for i in range(rows)])
+    db.session.commit()
+
+
+def _orm_path():
+    movies = Movie.query.order_by(Movie.id).all()
+    return jsonify({'success': True,
+                    'movies': [movie.format() for movie in movies]}).get_data()
+
+
+def _columns_path():
+    fields = list(Movie.FIELDS)
+    rows = Movie.query.with_entities(*[getattr(Movie, name) for name in fields]) \
+        .order_by(Movie.id).all()
+    return serializers.dumps({'success': True,
+                              'movies': serializers.row_dicts(fields, rows)})
+
+
+def _time(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    app = Flask(__name__)
+    setup_for_db(app, 'sqlite:///' + os.path.join(directory, 'bench.db'))
+    upgrade_schema(app)
+    app.app_context().push()
+    _seed(args.rows)
+
+    cases = [('orm + format + jsonify', _orm_path, 'stdlib'),
+             ('columns + stdlib', _columns_path, 'stdlib')]
+    if serializers.orjson is not None:
+        cases.append(('columns + orjson', _columns_path, 'auto'))
+
+    print(f'{args.rows} rows, median of {args.repeat} runs')
+    baseline = None
+    for label, f, backend in cases:
+        serializers.JSON_BACKEND = backend
+        seconds = _time(f, args.repeat)
+        baseline = baseline or seconds
+        print(f'{label:<28} {seconds * 1000:9.2f} ms  {baseline / seconds:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
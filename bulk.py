@@ -0,0 +1,231 @@
+import os
+from datetime import date
+from flask import request, abort
+from sqlalchemy.exc import SQLAlchemyError
+
+from model import db, parse_date, save
+
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 10000))
+
+
+class ItemError(Exception):
+    def __init__(self, message, status_code=400):
+        self.message = message
+        self.status_code = status_code
+
+
+'''
+bulk_args(key)
+    reads the body of a bulk request: {<key>: [...], "atomic": true}
+
+    atomic (default true) writes every item or none of them,
+    atomic false writes the valid items and reports the others
+    aborts with 400 if the body is malformed
+'''
+
+
+def bulk_args(key):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+
+    items = data.get(key, None)
+    atomic = data.get('atomic', True)
+    if not isinstance(items, list) or not items or \
+            len(items) > MAX_BULK_ITEMS or not isinstance(atomic, bool):
+        abort(400)
+    return items, atomic
+
+
+def _editable_fields(model):
+    return [name for name in model.FIELDS if name != 'id']
+
+
+def _check_value(model, name, value):
+    expected = model.__table__.c[name].type.python_type
+    if expected is date:
+        try:
+            return parse_date(value)
+        except ValueError:
+            raise ItemError(f'Invalid value for {name}')
+    if value is None or isinstance(value, bool) or \
+            not isinstance(value, expected):
+        raise ItemError(f'Invalid value for {name}')
+    return value
+
+
+def _check_id(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ItemError('Invalid id')
+    return value
+
+
+def _validate_new(model, item):
+    if not isinstance(item, dict):
+        raise ItemError('Item must be an object')
+
+    values = {}
+    for name in _editable_fields(model):
+        if name not in item:
+            raise ItemError(f'Missing field: {name}')
+        values[name] = _check_value(model, name, item[name])
+    return values
+
+
+def _validate_changes(model, item):
+    if not isinstance(item, dict) or 'id' not in item:
+        raise ItemError('Item must be an object with an id')
+
+    values = {'id': _check_id(item['id'])}
+    for name in _editable_fields(model):
+        if name in item:
+            values[name] = _check_value(model, name, item[name])
+    if len(values) == 1:
+        raise ItemError('Nothing to update')
+    return values
+
+
+def _existing_ids(model, ids):
+    rows = model.query.with_entities(model.id) \
+        .filter(model.id.in_(ids)).all()
+    return {row.id for row in rows}
+
+
+def _validate(items, validate):
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, validate(item)))
+        except ItemError as e:
+            results[index] = {
+                'index': index,
+                'status': e.status_code,
+                'error': e.message
+            }
+    return results, valid
+
+
+def _check_exists(model, results, valid):
+    existing = _existing_ids(model, [values['id'] for _, values in valid])
+    found = []
+    for index, values in valid:
+        if values['id'] in existing:
+            found.append((index, values))
+        else:
+            results[index] = {
+                'index': index,
+                'status': 404,
+                'error': 'Resource not found'
+            }
+    return found
+
+
+def _write(results, valid, write):
+    """Writes every valid item in one statement, falling back to one
+    savepoint per item so a failing row only fails itself
+    """
+    try:
+        with db.session.begin_nested():
+            ids = write([values for _, values in valid])
+    except SQLAlchemyError:
+        ids = []
+        for _, values in valid:
+            try:
+                with db.session.begin_nested():
+                    ids.append(write([values])[0])
+            except SQLAlchemyError:
+                ids.append(None)
+
+    for (index, _), item_id in zip(valid, ids):
+        if item_id is None:
+            results[index] = {
+                'index': index,
+                'status': 422,
+                'error': 'Unprocessable'
+            }
+        else:
+            results[index] = {'index': index, 'status': 200, 'id': item_id}
+
+
+def _run(results, valid, write, atomic):
+    """Returns True when the payload was written, False when an atomic
+    payload was rejected by validation
+    """
+    if atomic and len(valid) != len(results):
+        for index, _ in valid:
+            if results[index] is None:
+                results[index] = {
+                    'index': index,
+                    'status': 424,
+                    'error': 'Not written, the payload has invalid items'
+                }
+        db.session.rollback()
+        return False
+
+    try:
+        if atomic:
+            ids = write([values for _, values in valid])
+            for (index, _), item_id in zip(valid, ids):
+                results[index] = {'index': index, 'status': 200, 'id': item_id}
+        elif valid:
+            _write(results, valid, write)
+        save()
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+
+'''
+bulk_create(model, items, atomic)
+bulk_update(model, items, atomic)
+bulk_delete(model, ids, atomic)
+    validate the whole payload up front, then write it in a single transaction
+    with one statement per operation
+
+returns (results, written) where results holds one {"index", "status", "id" or "error"}
+    entry per item, and written is False if an atomic payload was rejected
+    raises SQLAlchemyError if an atomic write fails (nothing is written)
+'''
+
+
+def bulk_create(model, items, atomic=True):
+    results, valid = _validate(items,
+                               lambda item: _validate_new(model, item))
+    written = _run(results, valid, model.bulk_insert, atomic)
+    return results, written
+
+
+def bulk_update(model, items, atomic=True):
+    results, valid = _validate(items,
+                               lambda item: _validate_changes(model, item))
+    valid = _check_exists(model, results, valid)
+    written = _run(results, valid, model.bulk_update, atomic)
+    return results, written
+
+
+def bulk_delete(model, ids, atomic=True):
+    results, valid = _validate(ids, lambda item: {'id': _check_id(item)})
+    valid = _check_exists(model, results, valid)
+    written = _run(results, valid,
+                   lambda rows: model.bulk_delete([row['id'] for row in rows]),
+                   atomic)
+    return results, written
+
+
+'''
+bulk_import(model, items)
+    writes the valid `items` like a non-atomic POST /<model>/bulk, in one
+    statement with a savepoint per item when it fails, for the import jobs
+    (see jobs.py). it does not commit
+returns one {"index", "status", "id" or "error"} entry per item
+'''
+
+
+def bulk_import(model, items):
+    results, valid = _validate(items,
+                               lambda item: _validate_new(model, item))
+    if valid:
+        _write(results, valid, model.bulk_insert)
+    return results
@@ -0,0 +1,212 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import g, request, make_response
+
+from compression import choose_encoding, compress, compressible, encode_response
+from model import on_tables_changed
+
+RESPONSE_CACHE_ENABLED = os.environ.get(
+    'RESPONSE_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', None)
+
+
+'''
+LocalCacheBackend
+    bounded in-process LRU with per entry expiry
+
+    every gunicorn worker holds its own copy and counters, so a write only
+    bumps the counters of the worker that made it. behind @conditional the
+    entries are keyed by the versions stored in the database instead, which
+    every worker reads; otherwise the other workers catch up after at most
+    RESPONSE_CACHE_TTL seconds, use a shared backend to avoid that.
+'''
+
+
+class LocalCacheBackend:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_counters(self, names):
+        with self._lock:
+            return [self._counters.get(name, 0) for name in names]
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+
+'''
+RedisCacheBackend
+    cache shared by every worker, stored in redis
+
+    `client` is anything with the get/set(ex=)/mget/incr methods of redis.Redis,
+    by default one is created from `url` (the redis package is only needed then)
+'''
+
+
+class RedisCacheBackend:
+    def __init__(self, url=RESPONSE_CACHE_URL, client=None, prefix='fsnd:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+
+    def get_counters(self, names):
+        values = self.client.mget([self.prefix + 'counter:' + name
+                                   for name in names])
+        return [int(value) if value is not None else 0 for value in values]
+
+    def incr(self, name):
+        return self.client.incr(self.prefix + 'counter:' + name)
+
+    def clear(self):
+        pass
+
+
+'''
+ResponseCache
+    read-through cache for GET responses
+
+    entries are keyed by path, query string and the current version of every
+    table the response depends on: the collection versions read by
+    @conditional for the ETag when it runs first, so a body is never cached
+    under the ETag of other data, otherwise the backend's counters. a
+    committed write to one of those tables bumps both (see
+    model.on_tables_changed), so stale entries are never read again and age
+    out of the backend.
+
+    the compressed body (see compression.py) is cached next to the entry,
+    one per encoding, so a hit is not compressed again
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend=None, ttl=RESPONSE_CACHE_TTL,
+                 enabled=RESPONSE_CACHE_ENABLED):
+        self.backend = backend or LocalCacheBackend()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.compressions = 0
+
+    def _key(self, tables):
+        known = g.get('collection_versions', {})
+        if all(table in known for table in tables):
+            source, versions = 'db', [known[table] for table in tables]
+        else:
+            source, versions = 'counters', self.backend.get_counters(tables)
+        query = urlencode(sorted(request.args.items(multi=True)))
+        tags = ','.join(f'{table}={version}'
+                        for table, version in zip(tables, versions))
+        return f'response:{request.path}?{query}#{source}:{tags}'
+
+    def _encode(self, key, response):
+        if not compressible(response):
+            return response
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+
+        encoded_key = f'{key};{encoding}'
+        data = self.backend.get(encoded_key)
+        if data is None:
+            self.compressions += 1
+            data = compress(response.get_data(), encoding)
+            self.backend.set(encoded_key, data, self.ttl)
+        return encode_response(response, encoding, data)
+
+    def invalidate(self, tables):
+        for table in sorted(tables):
+            self.backend.incr(table)
+
+    def cached(self, tables):
+        tables = sorted(tables)
+
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+
+                key = self._key(tables)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    body, status, content_type = entry
+                    response = make_response(body, status)
+                    response.content_type = content_type
+                    return self._encode(key, response)
+
+                self.misses += 1
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(key, (response.get_data(),
+                                           response.status_code,
+                                           response.content_type), self.ttl)
+                    return self._encode(key, response)
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'compressions': self.compressions
+        }
+
+
+response_cache = ResponseCache(
+    RedisCacheBackend() if RESPONSE_CACHE_URL else LocalCacheBackend())
+
+
+@on_tables_changed
+def _invalidate_responses(tables):
+    response_cache.invalidate(tables)
@@ -0,0 +1,215 @@
+import logging
+import os
+import select
+import threading
+import time
+from flask import request, abort
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+import aio
+from model import db, Change, CHANGE_LOG_TABLES, CHANGES_CHANNEL, on_tables_changed
+from queries import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from serializers import dumps
+
+logger = logging.getLogger(__name__)
+
+# seconds between two reads of the change log by a stream that is not woken
+# up by notifications (no LISTEN on this database)
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+# seconds after which an idle stream sends a comment, so proxies keep it open
+CHANGES_KEEPALIVE = float(os.environ.get('CHANGES_KEEPALIVE', 15))
+# seconds a stream stays open, EventSource then reconnects with Last-Event-ID.
+# below gunicorn's timeout, the sync workers are busy for as long
+CHANGES_STREAM_TIMEOUT = float(os.environ.get('CHANGES_STREAM_TIMEOUT', 25))
+# milliseconds EventSource waits before reconnecting
+CHANGES_RETRY = int(os.environ.get('CHANGES_RETRY', 1000))
+
+
+def _int_value(value, default):
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def change_args():
+    """(since, limit) of the current request, since defaults to the
+    Last-Event-ID header of a reconnecting EventSource, then to 0
+    """
+    since = _int_value(request.args.get('since', None),
+                       _int_value(request.headers.get('Last-Event-ID', None), 0))
+    limit = _int_value(request.args.get('limit', None), DEFAULT_PAGE_SIZE)
+    if since < 0 or limit < 1:
+        abort(400)
+    return since, min(limit, MAX_PAGE_SIZE)
+
+
+def read_changes(since, limit):
+    """The first `limit` changes after the seq `since`
+    """
+    changes = Change.query.filter(Change.seq > since) \
+        .order_by(Change.seq).limit(limit).all()
+    return [change.format() for change in changes]
+
+
+def _listen_url(url):
+    # LISTEN needs a connection of its own outside of the pool, through
+    # psycopg2 whichever driver the app uses
+    url = make_url(url)
+    if url.get_backend_name() != 'postgresql':
+        return None
+    if 'ssl' in url.query:
+        # back from asyncpg's spelling, see model.async_database_path
+        query = dict(url.query)
+        query['sslmode'] = query.pop('ssl')
+        url = url.set(query=query)
+    return url.set(drivername='postgresql')
+
+
+'''
+ChangeFeed
+    wakes up the change streams of this process when changes are committed
+
+    the commits of this process wake them directly. with postgres, a thread
+    LISTENs to CHANGES_CHANNEL (notified by model._append_changes) for the
+    commits of the other processes, otherwise streams read the change log
+    every CHANGES_POLL_INTERVAL seconds. like the import workers, the
+    thread is started by the first stream, never before a fork
+'''
+
+
+class ChangeFeed:
+    def __init__(self):
+        self.generation = 0
+        self.listening = False
+        self.streams = 0
+        self.notifications = 0
+        self._condition = threading.Condition()
+        self._pid = None
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, seen, timeout):
+        """Waits at most `timeout` seconds for a generation other than
+        `seen`, returns the current one
+        """
+        if not aio.on_event_loop():
+            with self._condition:
+                self._condition.wait_for(lambda: self.generation != seen, timeout)
+            return self.generation
+
+        deadline = time.monotonic() + timeout
+        while self.generation == seen and time.monotonic() < deadline:
+            aio.sleep(min(0.05, max(0.0, deadline - time.monotonic())))
+        return self.generation
+
+    def start(self, url):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        url = _listen_url(url)
+        if url is not None:
+            threading.Thread(target=self._listen, args=(url,), daemon=True,
+                             name='change-feed').start()
+
+    def _listen(self, url):
+        try:
+            engine = create_engine(url, poolclass=NullPool)
+        except ImportError:
+            logger.warning('psycopg2 is not installed, change streams poll the change log')
+            return
+        while True:
+            try:
+                connection = engine.raw_connection()
+                try:
+                    connection.connection.autocommit = True
+                    connection.cursor().execute(f'LISTEN {CHANGES_CHANNEL}')
+                    self.listening = True
+                    # changes may have been committed while not listening
+                    self.notify()
+                    self._receive(connection.connection)
+                finally:
+                    self.listening = False
+                    connection.close()
+            except Exception:
+                logger.warning('Change feed connection lost', exc_info=True)
+                time.sleep(CHANGES_POLL_INTERVAL)
+
+    def _receive(self, connection):
+        while True:
+            if select.select([connection], [], [], CHANGES_KEEPALIVE) == ([], [], []):
+                continue
+            connection.poll()
+            if connection.notifies:
+                self.notifications += len(connection.notifies)
+                del connection.notifies[:]
+                self.notify()
+
+    def stats(self):
+        return {
+            'listening': self.listening,
+            'streams': self.streams,
+            'notifications': self.notifications
+        }
+
+
+change_feed = ChangeFeed()
+
+
+@on_tables_changed
+def _wake_streams(tables):
+    if not tables.isdisjoint(CHANGE_LOG_TABLES):
+        change_feed.notify()
+
+
+def _event(change):
+    return b'id: %d\nevent: change\ndata: %s\n\n' % (change['seq'], dumps(change))
+
+
+'''
+change_events(since, limit)
+    yields the changes after the seq `since` as server-sent events (the
+    event id is the seq), in batches of `limit`, then the later ones as they
+    are committed, for CHANGES_STREAM_TIMEOUT seconds
+
+    no database connection is held while waiting. waiting yields to the
+    event loop in the ASGI mode, under the sync workers a stream keeps its
+    worker busy
+'''
+
+
+def change_events(since, limit):
+    change_feed.streams += 1
+    try:
+        deadline = time.monotonic() + CHANGES_STREAM_TIMEOUT
+        last_sent = time.monotonic()
+        yield b'retry: %d\n\n' % CHANGES_RETRY
+        while True:
+            seen = change_feed.generation
+            changes = read_changes(since, limit)
+            db.session.close()
+            for change in changes:
+                yield _event(change)
+                since = change['seq']
+            if changes:
+                last_sent = time.monotonic()
+            if len(changes) == limit:
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            interval = CHANGES_KEEPALIVE if change_feed.listening else CHANGES_POLL_INTERVAL
+            change_feed.wait(seen, min(remaining, interval))
+            if time.monotonic() - last_sent >= CHANGES_KEEPALIVE:
+                yield b': keepalive\n\n'
+                last_sent = time.monotonic()
+    finally:
+        change_feed.streams -= 1
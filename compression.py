@@ -0,0 +1,95 @@
+import gzip
+import os
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() not in ('0', 'false', 'no')
+
+
+COMPRESSION_ENABLED = _env_flag('COMPRESSION_ENABLED', 'true')
+# bodies smaller than this are sent as they are, compressing them does not pay
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+
+
+def encodings():
+    """The encodings this process can produce, preferred first
+    """
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding():
+    """The encoding to send the current request's response in, None for
+    identity. the client's highest q value wins, ties go to brotli
+    """
+    if not COMPRESSION_ENABLED:
+        return None
+    accepted = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in encodings():
+        quality = accepted[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+
+def compressible(response):
+    """Whether `response` is worth compressing, whatever the client accepts
+    """
+    return COMPRESSION_ENABLED and response.status_code == 200 and \
+        not response.is_streamed and not response.direct_passthrough and \
+        'Content-Encoding' not in response.headers and \
+        response.mimetype in COMPRESSIBLE_TYPES and \
+        response.content_length is not None and \
+        response.content_length >= COMPRESSION_MIN_SIZE
+
+
+def encode_response(response, encoding, data):
+    """Replaces the body of `response` with `data`, its `encoding` form
+    """
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+'''
+init_app(app)
+    compresses the json and text responses of `app` with brotli (when the
+    brotli package is installed) or gzip, as negotiated with Accept-Encoding
+
+    responses below COMPRESSION_MIN_SIZE bytes, streamed responses (exports)
+    and error responses are sent as they are. every compressible response
+    carries Vary: Accept-Encoding, so caches keep one copy per encoding.
+    responses encoded already (cache.ResponseCache keeps the encoded bodies)
+    are left alone
+'''
+
+
+def init_app(app):
+    @app.after_request
+    def compress_response(response):
+        if not compressible(response):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+        return encode_response(response, encoding,
+                               compress(response.get_data(), encoding))
@@ -0,0 +1,100 @@
+import hashlib
+import os
+from functools import wraps
+from urllib.parse import urlencode
+from flask import g, request, make_response
+
+from model import db, CollectionVersion
+
+# seconds clients and shared caches may reuse a response without asking,
+# 0 makes them revalidate every time (answered with a cheap 304)
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 0))
+
+
+def collection_state(tables):
+    """Returns ({table: version}, last modified time) for the given tables
+    """
+    rows = db.session.query(CollectionVersion) \
+        .filter(CollectionVersion.name.in_(tables)).all()
+    versions = {row.name: row.version for row in rows}
+    last_modified = max((row.updated_at for row in rows), default=None)
+    return versions, last_modified
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified:
+        # http dates have a one second resolution
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def cache_control(response):
+    response.cache_control.public = True
+    if HTTP_CACHE_MAX_AGE:
+        response.cache_control.max_age = HTTP_CACHE_MAX_AGE
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+'''
+@conditional(tables, model, id_arg)
+    answers conditional GET requests from version metadata alone
+
+    the ETag is derived from the request path and query string and the
+    version of every table in `tables` (plus, for a single row endpoint,
+    the updated_at of the row with id kwargs[id_arg]). when If-None-Match or
+    If-Modified-Since show the client already has it, a 304 is returned
+    without calling the view.
+
+    versions are read before the view runs, so a response can only ever be
+    newer than its ETag, never older. they are left in g.collection_versions
+    for the response cache (see cache.ResponseCache) to key the body by.
+    the ETag is weak: it names the data, not the bytes, which differ with
+    the json backend and the compression
+
+    the responses are public, with Cache-Control max-age HTTP_CACHE_MAX_AGE
+    (no-cache when 0, i.e. revalidate before every use)
+'''
+
+
+def conditional(tables, model=None, id_arg=None):
+    tables = sorted(tables)
+
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = collection_state(tables)
+            # the response cache keys the body by the same versions as the ETag
+            g.collection_versions = {table: versions.get(table, 0) for table in tables}
+            parts = [request.path, urlencode(sorted(request.args.items(multi=True)))]
+            parts += [f'{table}:{versions.get(table, 0)}' for table in tables]
+
+            if model is not None:
+                row_modified = db.session.query(model.updated_at) \
+                    .filter(model.id == kwargs[id_arg]).scalar()
+                if row_modified is None:
+                    return f(*args, **kwargs)
+                parts.append(row_modified.isoformat())
+                last_modified = max(filter(None, (last_modified, row_modified)))
+
+            etag = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+            if _not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            return cache_control(response)
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,24 @@
+'''
+gunicorn settings, read from the working directory by
+`gunicorn main:APP` and `gunicorn -k uvicorn.workers.UvicornWorker asgi:app`
+
+    the schema is upgraded once, in the master before the workers start,
+    instead of by every worker (AUTO_MIGRATE=false to run
+    `flask --app main db upgrade` yourself)
+
+    creating the app opens no connection and starts no thread, so it can be
+    built once in the master with --preload and shared by the workers
+
+    the server refuses to start without DATABASE_URL: the local default of
+    model.database_path is meant for development, not for a deployment
+'''
+import os
+
+
+def on_starting(server):
+    if not os.environ.get('DATABASE_URL'):
+        raise RuntimeError('DATABASE_URL is not set')
+    from model import AUTO_MIGRATE, migration_app, upgrade_schema
+    if AUTO_MIGRATE:
+        # not the serving app, whose pool is the one the metrics report
+        upgrade_schema(migration_app())
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, abort, make_response
+from sqlalchemy.exc import IntegrityError
+
+from model import db, save, IdempotencyKey
+
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+IDEMPOTENCY_PURGE_INTERVAL = int(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 300))
+MAX_KEY_LENGTH = 255
+
+_last_purge = None
+
+
+def _fingerprint():
+    digest = hashlib.sha256()
+    for part in (request.method, request.path, request.query_string):
+        digest.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _replay(record):
+    response = make_response(record.body, record.status_code)
+    response.content_type = record.content_type
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _existing(key, fingerprint):
+    """Answers a repeated request from its stored record, None when there is none
+    """
+    record = db.session.get(IdempotencyKey, key)
+    if record is None:
+        return None
+    if record.expires_at <= datetime.utcnow():
+        db.session.delete(record)
+        save()
+        return None
+
+    if record.fingerprint != fingerprint:
+        # the same key was used for a different request
+        abort(422)
+    if record.status_code is None:
+        # the first request is still running
+        abort(409)
+    return _replay(record)
+
+
+def purge_expired_keys():
+    """Deletes the expired keys, returns how many were deleted
+    """
+    deleted = IdempotencyKey.query \
+        .filter(IdempotencyKey.expires_at <= datetime.utcnow()) \
+        .delete(synchronize_session=False)
+    save()
+    return deleted
+
+
+def _purge_if_due():
+    global _last_purge
+    now = time.monotonic()
+    if _last_purge is None or now - _last_purge >= IDEMPOTENCY_PURGE_INTERVAL:
+        _last_purge = now
+        purge_expired_keys()
+
+
+def _store(key, fingerprint, response):
+    # the view may have rolled back the claim (e.g. a rejected bulk payload)
+    record = db.session.get(IdempotencyKey, key)
+    if record is None:
+        record = IdempotencyKey(key=key, fingerprint=fingerprint,
+                                expires_at=datetime.utcnow() +
+                                timedelta(seconds=IDEMPOTENCY_KEY_TTL))
+        db.session.add(record)
+    record.status_code = response.status_code
+    record.body = response.get_data(as_text=True)
+    record.content_type = response.content_type
+    try:
+        save()
+    except IntegrityError:
+        # claimed again by a concurrent retry in the meantime
+        db.session.rollback()
+
+
+def _release(key):
+    db.session.rollback()
+    IdempotencyKey.query \
+        .filter(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)) \
+        .delete(synchronize_session=False)
+    save()
+
+
+'''
+@idempotent
+    makes a POST endpoint safe to retry with an Idempotency-Key header
+
+    the key (scoped to the caller's `sub`) is claimed, and its response
+    stored when the view returns, in the same transaction as the rows the
+    view writes (see model.transactional). a request repeating the key
+    within IDEMPOTENCY_KEY_TTL seconds is answered from the store, without
+    running the view, with an Idempotent-Replayed header. reusing a key for a different request (method,
+    path, query or body) is answered with 422, a retry that arrives while
+    the first request still runs with 409.
+
+    responses with a 5xx status or an exception are not stored, the key can
+    be retried. requests without the header are not affected.
+
+    must be applied below @requires_auth, it reads the jwt payload, and
+    below @transactional
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(jwt, *args, **kwargs):
+        header = request.headers.get('Idempotency-Key', None)
+        if header is None:
+            return f(jwt, *args, **kwargs)
+        if not header or len(header) > MAX_KEY_LENGTH:
+            abort(400)
+
+        key = f'{jwt.get("sub", "")}:{header}'
+        fingerprint = _fingerprint()
+        replay = _existing(key, fingerprint)
+        if replay is not None:
+            return replay
+
+        _purge_if_due()
+        db.session.add(IdempotencyKey(
+            key=key, fingerprint=fingerprint,
+            expires_at=datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_KEY_TTL)))
+        try:
+            # takes the key's unique index, a concurrent duplicate waits here
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            replay = _existing(key, fingerprint)
+            if replay is not None:
+                return replay
+            abort(409)
+
+        try:
+            response = make_response(f(jwt, *args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+
+        if response.status_code >= 500:
+            _release(key)
+        else:
+            _store(key, fingerprint, response)
+        return response
+
+    return wrapper
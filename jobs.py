@@ -0,0 +1,393 @@
+import asyncio
+import csv
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+from flask import g, request, abort
+from sqlalchemy import and_, func, or_
+
+import aio
+import replicas
+from bulk import bulk_import
+from model import db, save, unit_of_work, Movie, Actor, ImportJob
+
+logger = logging.getLogger(__name__)
+
+# background import workers per process (gunicorn worker), 0 leaves the
+# queue to `python jobs.py`
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 2))
+# rows parsed, validated and inserted per transaction
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 1024 * 1024 * 1024))
+# rows that could not be imported reported by GET /jobs/<id>, the others are only counted
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 100))
+# seconds an idle worker waits before looking for jobs queued by other processes
+IMPORT_POLL_INTERVAL = float(os.environ.get('IMPORT_POLL_INTERVAL', 5))
+# seconds without progress after which a running job is taken over (its worker died)
+IMPORT_STALE_AFTER = float(os.environ.get('IMPORT_STALE_AFTER', 300))
+# where uploads wait for their job, shared by every process that runs jobs
+IMPORT_DIR = os.environ.get('IMPORT_DIR',
+                            os.path.join(tempfile.gettempdir(), 'fsnd-imports'))
+
+IMPORT_MODELS = {'movies': Movie, 'actors': Actor}
+FILE_TYPES = {
+    'csv': 'csv',
+    'text/csv': 'csv',
+    '.csv': 'csv',
+    'ndjson': 'ndjson',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def _save_upload(stream, path):
+    size = 0
+    with open(path, 'wb') as file:
+        while True:
+            data = stream.read(COPY_BUFFER_SIZE)
+            if not data:
+                return size
+            size += len(data)
+            if size > IMPORT_MAX_BYTES:
+                raise ValueError('Upload too large')
+            file.write(data)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+'''
+submit_import(model, owner)
+    stores the file uploaded with the current request and queues its import
+    into `model`'s table, without committing (see model.transactional)
+
+    the file is either the `file` field of a multipart form or the request
+    body. its type (csv or ndjson) is the `type` query parameter, or comes
+    from the content type or the file name. it is copied to IMPORT_DIR in
+    COPY_BUFFER_SIZE blocks, so memory use does not depend on its size
+
+    aborts with 400 for an unknown type, 413 for a file of more than
+    IMPORT_MAX_BYTES
+returns the ImportJob
+'''
+
+
+def submit_import(model, owner=None):
+    if request.content_length is not None and \
+            request.content_length > IMPORT_MAX_BYTES:
+        abort(413)
+
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, name, mimetype = upload.stream, upload.filename or '', upload.mimetype
+    else:
+        stream, name, mimetype = request.stream, '', request.mimetype
+    file_type = FILE_TYPES.get(request.args.get('type', None) or mimetype) or \
+        FILE_TYPES.get(os.path.splitext(name)[1].lower())
+    if file_type is None:
+        abort(400)
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_DIR, f'{job_id}.{file_type}')
+    try:
+        # a blocking copy, off the event loop in the ASGI mode
+        aio.run_blocking(_save_upload, stream, path)
+    except ValueError:
+        _remove(path)
+        abort(413)
+
+    job = ImportJob(id=job_id, target=model.__tablename__, file_type=file_type,
+                    path=path, owner=owner, status=ImportJob.QUEUED)
+    db.session.add(job)
+    try:
+        save()
+    except Exception:
+        _remove(path)
+        raise
+    return job
+
+
+def init_app(app):
+    """Forgets the job found by the previous request, g may outlive a
+    request (an app context pushed around several, e.g. in tests)
+    """
+    @app.before_request
+    def reset_import_job():
+        g.pop('import_job', None)
+
+
+def find_job(job_id):
+    """The job `job_id` of the current request, read once (GET /jobs/<id>
+    looks it up for its permission, then for its body)
+    """
+    job = g.get('import_job')
+    if job is not None and job.id == job_id:
+        return job
+    # a job queued a moment ago may not have reached the replicas yet
+    g.db_route = replicas.PRIMARY
+    job = db.session.get(ImportJob, job_id)
+    if job is None:
+        abort(404)
+    g.import_job = job
+    return job
+
+
+def _csv_item(model, row):
+    # csv only has strings, the integer columns are converted here and
+    # anything else is left to the validation of bulk_import
+    item = {}
+    for name, value in row.items():
+        if name not in model.__table__.c:
+            continue
+        if value == '':
+            value = None
+        elif model.__table__.c[name].type.python_type is int:
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        item[name] = value
+    return item
+
+
+def read_rows(file, file_type, model):
+    """Yields (line, item, error) for every row of an uploaded file, item is
+    the row as given to POST /<model>, error why it could not be read
+    """
+    if file_type == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, _csv_item(model, row), None
+        return
+
+    for line, text in enumerate(file, 1):
+        if not text.strip():
+            continue
+        try:
+            item = json.loads(text)
+        except ValueError:
+            yield line, None, 'Invalid JSON'
+            continue
+        yield line, item, None
+
+
+def _import_chunk(job, model, chunk):
+    parsed = [(line, item) for line, item, error in chunk if error is None]
+    errors = [{'line': line, 'error': error}
+              for line, _, error in chunk if error is not None]
+
+    # the rows and the progress are committed together, a job resumed by
+    # another worker starts right after the last committed chunk
+    with unit_of_work():
+        results = bulk_import(model, [item for _, item in parsed])
+        for (line, _), result in zip(parsed, results):
+            if result['status'] != 200:
+                errors.append({'line': line, 'error': result['error']})
+
+        reported = json.loads(job.errors) if job.errors else []
+        if len(reported) < IMPORT_MAX_ERRORS:
+            errors.sort(key=lambda error: error['line'])
+            job.errors = json.dumps(reported + errors[:IMPORT_MAX_ERRORS - len(reported)])
+        job.rows_read += len(chunk)
+        job.rows_failed += len(errors)
+        job.rows_imported += len(chunk) - len(errors)
+        job.heartbeat_at = datetime.utcnow()
+        save()
+
+
+def _finish(job, status, message=None):
+    with unit_of_work():
+        job.status = status
+        job.message = message
+        job.finished_at = job.heartbeat_at = datetime.utcnow()
+        save()
+    _remove(job.path)
+
+
+'''
+run_job(job)
+    imports the file of the claimed `job`, IMPORT_CHUNK_SIZE rows at a time:
+    each chunk is validated and written like a non-atomic bulk request, in a
+    transaction of its own that also records the job's progress
+
+    rows that cannot be read or written are counted (and the first
+    IMPORT_MAX_ERRORS reported with their line number), the job goes on.
+    a file that cannot be read at all fails the job. on a database error
+    the job is left running and is resumed once it is stale
+returns the final status
+'''
+
+
+def run_job(job):
+    model = IMPORT_MODELS[job.target]
+    try:
+        with open(job.path, newline='', encoding='utf-8') as file:
+            rows = itertools.islice(read_rows(file, job.file_type, model),
+                                    job.rows_read, None)
+            while True:
+                chunk = list(itertools.islice(rows, IMPORT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                _import_chunk(job, model, chunk)
+    except (OSError, UnicodeDecodeError, csv.Error) as error:
+        _finish(job, ImportJob.FAILED, str(error))
+    else:
+        _finish(job, ImportJob.SUCCEEDED)
+    return job.status
+
+
+def claim_job():
+    """Takes the oldest queued (or stale running) job, None when there is none
+    """
+    now = datetime.utcnow()
+    claimable = or_(
+        ImportJob.status == ImportJob.QUEUED,
+        and_(ImportJob.status == ImportJob.RUNNING,
+             ImportJob.heartbeat_at < now - timedelta(seconds=IMPORT_STALE_AFTER)))
+    candidates = [row.id for row in db.session.query(ImportJob.id)
+                  .filter(claimable).order_by(ImportJob.created_at).limit(10)]
+
+    for job_id in candidates:
+        # only one of the workers racing for a job updates its row
+        with unit_of_work():
+            claimed = ImportJob.query.filter(ImportJob.id == job_id, claimable) \
+                .update({'status': ImportJob.RUNNING, 'heartbeat_at': now,
+                         'started_at': func.coalesce(ImportJob.started_at, now)},
+                        synchronize_session=False)
+        if claimed:
+            return db.session.get(ImportJob, job_id)
+    db.session.rollback()
+    return None
+
+
+'''
+ImportWorkers
+    the background workers that run the import jobs of this process
+
+    they are started by the first import a process receives, not when the
+    app is created, so a gunicorn master that builds the app (--preload)
+    forks no thread, and a forked process starts its own. under the sync
+    workers they are threads, in the ASGI mode tasks on the event loop
+    whose database waits yield like those of a request (see aio)
+
+    a worker is woken up by the imports of its own process and otherwise
+    looks for queued jobs every `poll_interval` seconds, the queue being the
+    import_jobs table shared by every process
+'''
+
+
+class ImportWorkers:
+    def __init__(self, size=IMPORT_WORKERS, poll_interval=IMPORT_POLL_INTERVAL):
+        self.size = size
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._owner = None
+        self._wake = None
+        self.jobs = 0
+        self.failed = 0
+        self.errors = 0
+
+    def start(self, app):
+        """Starts the workers of this process (and event loop), once
+        """
+        loop = asyncio.get_event_loop() if aio.on_event_loop() else None
+        owner = (os.getpid(), loop)
+        if self.size < 1 or self._owner == owner:
+            return
+
+        aio.acquire(self._lock)
+        try:
+            if self._owner == owner:
+                return
+            self._owner = owner
+            if loop is not None:
+                self._wake = asyncio.Event()
+                for _ in range(self.size):
+                    loop.create_task(self._serve_async(app))
+            else:
+                self._wake = threading.Event()
+                for index in range(self.size):
+                    threading.Thread(target=self.serve, args=(app,), daemon=True,
+                                     name=f'import-worker-{index}').start()
+        finally:
+            self._lock.release()
+
+    def notify(self):
+        """Wakes the workers up, a job was queued
+        """
+        if self._wake is not None:
+            self._wake.set()
+
+    def work(self, app):
+        """Runs one job, returns whether there was one to run
+        """
+        with app.app_context():
+            try:
+                job = claim_job()
+                if job is None:
+                    return False
+                if run_job(job) == ImportJob.FAILED:
+                    self.failed += 1
+                self.jobs += 1
+                return True
+            except Exception:
+                self.errors += 1
+                logger.exception('Import job failed')
+                db.session.rollback()
+                return False
+
+    def run_pending(self, app):
+        """Runs jobs until the queue is empty
+        """
+        while self.work(app):
+            pass
+
+    def serve(self, app):
+        """Runs jobs forever, in the calling thread
+        """
+        if self._wake is None:
+            self._wake = threading.Event()
+        while True:
+            if not self.work(app):
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    async def _serve_async(self, app):
+        while True:
+            if not await aio.spawn(self.work, app):
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    def stats(self):
+        return {
+            'workers': self.size if self._owner is not None else 0,
+            'jobs': self.jobs,
+            'failed': self.failed,
+            'errors': self.errors
+        }
+
+
+import_workers = ImportWorkers()
+
+
+if __name__ == '__main__':
+    # a process that only runs import jobs, e.g. next to web workers started
+    # with IMPORT_WORKERS=0 (uploads must then be on a shared IMPORT_DIR)
+    from main import create_app
+    import_workers.serve(create_app())
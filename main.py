@@ -1,35 +1,145 @@
-from flask import Flask, abort, request, jsonify
-from model import setup_for_db
+import os
+from flask import Flask, Response, abort, request, jsonify, stream_with_context, after_this_request, current_app
+from model import setup_for_db, upgrade_schema, AUTO_MIGRATE
 from flask_cors import CORS
 
-from model import Movie, Actor
-from auth import requires_auth, AuthError
+from model import Movie, Actor, parse_date, transactional
+from auth import requires_auth, AuthError, get_key_store, token_cache
+from queries import listing_args, field_args, include_args, filter_query, eager_load, paginate, export_rows
+from bulk import bulk_args, bulk_create, bulk_update, bulk_delete
+from pool import pool_metrics
+from ratelimit import rate_limiter, load_shedder
+from replicas import replica_set
+from cache import response_cache
+from conditional import conditional
+from idempotency import idempotent
+from stats import cast_counts, actor_distributions
+import jobs
+from jobs import submit_import, find_job, import_workers
+from changes import change_args, read_changes, change_events, change_feed
+from serializers import json_response
+import compression
+import metrics
+
+CORS_MAX_AGE = int(os.environ.get('CORS_MAX_AGE', 86400))
+CORS_ALLOW_HEADERS = ['Content-Type', 'Authorization', 'Idempotency-Key',
+                      'If-None-Match', 'If-Modified-Since', 'Last-Event-ID']
+CORS_EXPOSE_HEADERS = ['ETag', 'Idempotent-Replayed', 'Location', 'Retry-After', 'Server-Timing']
+
+
+def bulk_response(results, written):
+    if not written:
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'Bad request',
+            'results': results
+        }), 400
+
+    return jsonify({
+        'success': True,
+        'results': results
+    }), 200
+
 
+def import_response(job):
+    import_workers.start(current_app._get_current_object())
 
-def create_app(test_config=None):
+    # after the request's transaction committed the job, for the workers to see it
+    @after_this_request
+    def wake_import_workers(response):
+        import_workers.notify()
+        return response
+
+    response = jsonify({
+        'success': True,
+        'jobs': [job.format()]
+    })
+    response.status_code = 202
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response
+
+
+def create_app(test_config=None, async_driver=False):
     # create app and database
     APP = Flask(__name__)
-    setup_for_db(APP)
-    CORS(APP)
-
-    # CORS Headers
-    @APP.after_request
-    def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type, Authorization')
-        response.headers.add('Access-Control-Allow-Headers',
-                             'GET, POST, PATCH, DELETE, OPTIONS')
-        return response
+    setup_for_db(APP, async_driver=async_driver)
+
+    # CORS Headers, browsers may reuse a preflight answer for CORS_MAX_AGE
+    # seconds instead of sending an OPTIONS request before every write
+    CORS(APP,
+         allow_headers=CORS_ALLOW_HEADERS,
+         methods=['GET', 'POST', 'PATCH', 'DELETE', 'OPTIONS'],
+         expose_headers=CORS_EXPOSE_HEADERS,
+         max_age=CORS_MAX_AGE)
+    metrics.init_app(APP)
+    # registered after metrics so the compression time is in Server-Timing
+    compression.init_app(APP)
+    jobs.init_app(APP)
+
+    '''
+    GET /status
+        it should be a public endpoint
+        it should not touch the database
+    returns status code 200 and json {"success": True, "pool": pool, "replicas": replicas, "rate_limit": ..., "load_shedding": ...,
+        "response_cache": cache, "imports": imports, "changes": changes} where pool holds the
+        connection pool counters of this worker (checkouts, wait times, timeouts, ...),
+        replicas the read replica health and routing counters, rate_limit and load_shedding
+        the requests turned away with 429 and 503, cache the response cache hit/miss counters,
+        imports the import jobs run by this worker and changes its open change streams
+    '''
+    @APP.route('/status', methods=['GET'])
+    def get_status():
+        return jsonify({
+            'success': True,
+            'pool': pool_metrics.stats(),
+            'replicas': replica_set.stats(),
+            'rate_limit': rate_limiter.stats(),
+            'load_shedding': load_shedder.stats(),
+            'response_cache': response_cache.stats(),
+            'imports': import_workers.stats(),
+            'changes': change_feed.stats()
+        }), 200
+
+    '''
+    GET /metrics
+        it should be a public endpoint, for the prometheus scraper
+        it should not touch the database
+    returns status code 200 and the metrics of this worker in the prometheus
+        text format: request latency, SQL queries and time per route, token
+        verification time, and the pool, replica, rate limit, load shedding, response cache, import, change feed, token cache and JWKS
+        key store counters (404 when METRICS_ENABLED is false)
+    '''
+    @APP.route('/metrics', methods=['GET'])
+    def get_metrics():
+        if not metrics.METRICS_ENABLED:
+            abort(404)
+
+        lines = metrics.request_metrics.render()
+        lines += metrics.render_stats('fsnd_db_pool', pool_metrics.stats())
+        lines += metrics.render_stats('fsnd_db_replicas', replica_set.stats())
+        lines += metrics.render_stats('fsnd_rate_limit', rate_limiter.stats())
+        lines += metrics.render_stats('fsnd_load_shedding', load_shedder.stats())
+        lines += metrics.render_stats('fsnd_response_cache', response_cache.stats())
+        lines += metrics.render_stats('fsnd_imports', import_workers.stats())
+        lines += metrics.render_stats('fsnd_changes', change_feed.stats())
+        lines += metrics.render_stats('fsnd_token_cache', token_cache.stats())
+        lines += metrics.render_stats('fsnd_jwks', get_key_store().stats())
+        return Response('\n'.join(lines) + '\n', status=200,
+                        mimetype='text/plain; version=0.0.4')
 
     '''
     POST /movies
         it should create a new row in the movies table
         it should require the 'post:movies' permission
+        it should accept an Idempotency-Key header, a retry with the same key is answered with the first response (see idempotency.py)
     returns status code 200 and json {"success": True, "movies": movie} where movies an array containing only the newly created movie
         or appropriate status code indicating reason for failure
     '''
     @APP.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @transactional
+    @idempotent
     def create_movie(jwt):
         data = request.get_json()
         if data is None:
@@ -40,6 +150,11 @@ def create_app(test_config=None):
         if title is None or release_date is None:
             abort(400)
 
+        try:
+            release_date = parse_date(release_date)
+        except ValueError:
+            abort(400)
+
         try:
             movie = Movie(title=title,
                           release_date=release_date)
@@ -55,21 +170,76 @@ def create_app(test_config=None):
     '''
     GET /movies
         it should be a public endpoint
-    returns status code 200 and json {"success": True, "movies": movies} where movies is the list of movies
+        responses are cached until a movie or actor is written (see cache.py)
+        it should answer If-None-Match / If-Modified-Since with 304 when nothing changed (see conditional.py)
+        it should accept the optional query parameters
+            limit: page size
+            after: the `next` cursor of the previous page
+            fields: comma separated list of columns to return (id is always returned)
+            include: 'actors' to embed the related actors of each movie
+            title_prefix: case-insensitive prefix of the title
+            q: case-insensitive text contained in the title
+            released_after, released_before: inclusive release date bounds (YYYY-MM-DD)
+            order: 'release_date' to order by release date (movies without one are left out)
+    returns status code 200 and json {"success": True, "movies": movies, "next": cursor} where movies is one page of movies
+        and cursor is the `after` value of the next page (null on the last page)
         or appropriate status code indicating reason for failure
     '''
     @APP.route('/movies', methods=['GET'])
+    @conditional(('movies', 'actors'))
+    @response_cache.cached(('movies', 'actors'))
     def get_movies():
+        listing = listing_args(Movie)
+        query = filter_query(Movie.query, Movie)
         try:
-            movies = Movie.query.order_by(Movie.id).all()
+            movies, next_cursor = paginate(query, Movie, listing)
 
-            return jsonify({
+            return json_response({
                 'success': True,
-                'movies': [movie.format() for movie in movies]
-            }), 200
+                'movies': movies,
+                'next': next_cursor
+            }, 200)
         except:
             abort(422)
 
+    '''
+    GET /movies/<id>
+        where <id> is the existing model id
+        it should be a public endpoint
+        it should respond with a 404 error if <id> is not found
+        it should accept the optional `include` query parameter ('actors') to embed the related actors
+        it should answer If-None-Match / If-Modified-Since with 304 when nothing changed
+    returns status code 200 and json {"success": True, "movies": movie} where movies an array containing only the movie
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/movies/<int:movie_id>', methods=['GET'])
+    @conditional(('actors',), Movie, 'movie_id')
+    def get_movie(movie_id):
+        include = include_args(Movie)
+        movie = eager_load(Movie.query, Movie, include) \
+            .filter(Movie.id == movie_id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movies': [movie.format(include)]
+        }), 200
+
+    '''
+    GET /movies/export
+        it should require the 'get:movies' permission
+        it should accept the optional `fields` query parameter and the filters of GET /movies
+    returns status code 200 and a newline delimited json stream with one movie per line, ordered by id
+    '''
+    @APP.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(jwt):
+        fields = field_args(Movie)
+        query = filter_query(Movie.query, Movie)
+        return Response(stream_with_context(export_rows(query, Movie, fields)),
+                        mimetype='application/x-ndjson')
+
     '''
     PATCH /movies/<id>
         where <id> is the existing model id
@@ -81,6 +251,7 @@ def create_app(test_config=None):
     '''
     @APP.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @transactional
     def update_movie(jwt, movie_id):
         movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         if movie is None:
@@ -95,6 +266,11 @@ def create_app(test_config=None):
         if new_title is None or new_release_date is None:
             abort(400)
 
+        try:
+            new_release_date = parse_date(new_release_date)
+        except ValueError:
+            abort(400)
+
         try:
             movie.title = new_title
             movie.release_date = new_release_date
@@ -118,6 +294,7 @@ def create_app(test_config=None):
     '''
     @APP.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
+    @transactional
     def delete_movie(jwt, movie_id):
         movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         if movie is None:
@@ -133,15 +310,80 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    '''
+    POST /movies/bulk
+        it should create one row in the movies table per item of {"movies": [...]}
+        it should require the 'post:movies' permission
+        it should accept an Idempotency-Key header, a retry with the same key is answered with the first response (see idempotency.py)
+        it should validate every item before writing any of them
+        with "atomic": true (default) it should write all items or none of them,
+            with "atomic": false it should write the valid items and report the others
+    returns status code 200 and json {"success": True, "results": results} where results has one
+        {"index", "status", "id" or "error"} entry per item
+        or status code 400 with the per-item results if an atomic payload has invalid items
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @transactional
+    @idempotent
+    def bulk_create_movies(jwt):
+        items, atomic = bulk_args('movies')
+        try:
+            results, written = bulk_create(Movie, items, atomic)
+        except:
+            abort(422)
+        return bulk_response(results, written)
+
+    '''
+    PATCH /movies/bulk
+        it should update one row per item of {"movies": [...]}, each item holding
+            the movie id and the fields to change
+        it should require the 'patch:movies' permission
+        it should support "atomic" like POST /movies/bulk
+    returns the same shape as POST /movies/bulk, unknown ids are reported with status 404
+    '''
+    @APP.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    @transactional
+    def bulk_update_movies(jwt):
+        items, atomic = bulk_args('movies')
+        try:
+            results, written = bulk_update(Movie, items, atomic)
+        except:
+            abort(422)
+        return bulk_response(results, written)
+
+    '''
+    DELETE /movies/bulk
+        it should delete the rows listed in {"ids": [...]}
+        it should require the 'delete:movies' permission
+        it should support "atomic" like POST /movies/bulk
+    returns the same shape as POST /movies/bulk, unknown ids are reported with status 404
+    '''
+    @APP.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    @transactional
+    def bulk_delete_movies(jwt):
+        ids, atomic = bulk_args('ids')
+        try:
+            results, written = bulk_delete(Movie, ids, atomic)
+        except:
+            abort(422)
+        return bulk_response(results, written)
+
     '''
     POST /actors
         it should create a new row in the actors table
         it should require the 'post:actors' permission
+        it should accept an Idempotency-Key header, a retry with the same key is answered with the first response (see idempotency.py)
     returns status code 200 and json {"success": True, "actors": actor} where actors an array containing only the newly created actor
         or appropriate status code indicating reason for failure
     '''
     @APP.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @transactional
+    @idempotent
     def create_actor(jwt):
         data = request.get_json()
         if data is None:
@@ -153,6 +395,10 @@ def create_app(test_config=None):
         movie_id = data.get('movie_id', None)
         if name is None or age is None or gender is None or movie_id is None:
             abort(400)
+        try:
+            age = int(age)
+        except (TypeError, ValueError):
+            abort(400)
 
         try:
             actor = Actor(name=name, age=age,
@@ -169,21 +415,75 @@ def create_app(test_config=None):
     '''
     GET /actors
         it should be a public endpoint
-    returns status code 200 and json {"success": True, "actors": actors} where actors is the list of actors
+        responses are cached until a movie or actor is written (see cache.py)
+        it should answer If-None-Match / If-Modified-Since with 304 when nothing changed (see conditional.py)
+        it should accept the optional query parameters
+            limit: page size
+            after: the `next` cursor of the previous page
+            fields: comma separated list of columns to return (id is always returned)
+            include: 'movie' to embed the related movie of each actor
+            movie_id, gender: exact match
+            age_min, age_max: inclusive age bounds
+            name_prefix: case-insensitive prefix of the name
+    returns status code 200 and json {"success": True, "actors": actors, "next": cursor} where actors is one page of actors
+        and cursor is the `after` value of the next page (null on the last page)
         or appropriate status code indicating reason for failure
     '''
     @APP.route('/actors', methods=['GET'])
+    @conditional(('movies', 'actors'))
+    @response_cache.cached(('movies', 'actors'))
     def get_actors():
+        listing = listing_args(Actor)
+        query = filter_query(Actor.query, Actor)
         try:
-            actors = Actor.query.order_by(Actor.id).all()
+            actors, next_cursor = paginate(query, Actor, listing)
 
-            return jsonify({
+            return json_response({
                 'success': True,
-                'actors': [actor.format() for actor in actors]
-            }), 200
+                'actors': actors,
+                'next': next_cursor
+            }, 200)
         except:
             abort(422)
 
+    '''
+    GET /actors/<id>
+        where <id> is the existing model id
+        it should be a public endpoint
+        it should respond with a 404 error if <id> is not found
+        it should accept the optional `include` query parameter ('movie') to embed the related movie
+        it should answer If-None-Match / If-Modified-Since with 304 when nothing changed
+    returns status code 200 and json {"success": True, "actors": actor} where actors an array containing only the actor
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/actors/<int:actor_id>', methods=['GET'])
+    @conditional(('movies',), Actor, 'actor_id')
+    def get_actor(actor_id):
+        include = include_args(Actor)
+        actor = eager_load(Actor.query, Actor, include) \
+            .filter(Actor.id == actor_id).one_or_none()
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actors': [actor.format(include)]
+        }), 200
+
+    '''
+    GET /actors/export
+        it should require the 'get:actors' permission
+        it should accept the optional `fields` query parameter and the filters of GET /actors
+    returns status code 200 and a newline delimited json stream with one actor per line, ordered by id
+    '''
+    @APP.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(jwt):
+        fields = field_args(Actor)
+        query = filter_query(Actor.query, Actor)
+        return Response(stream_with_context(export_rows(query, Actor, fields)),
+                        mimetype='application/x-ndjson')
+
     '''
     PATCH /actors/<id>
         where <id> is the existing model id
@@ -195,6 +495,7 @@ def create_app(test_config=None):
     '''
     @APP.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
+    @transactional
     def update_actor(jwt, actor_id):
         actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
         if actor is None:
@@ -210,6 +511,10 @@ def create_app(test_config=None):
         new_movie_id = data.get('movie_id', None)
         if new_name is None or new_age is None or new_gender is None or new_movie_id is None:
             abort(400)
+        try:
+            new_age = int(new_age)
+        except (TypeError, ValueError):
+            abort(400)
 
         try:
             actor.gender = new_gender
@@ -235,6 +540,7 @@ def create_app(test_config=None):
     '''
     @APP.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
+    @transactional
     def delete_actor(jwt, actor_id):
         actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
         if actor is None:
@@ -250,6 +556,203 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    '''
+    POST /actors/bulk
+        it should create one row in the actors table per item of {"actors": [...]}
+        it should require the 'post:actors' permission
+        it should accept an Idempotency-Key header, a retry with the same key is answered with the first response (see idempotency.py)
+        it should validate every item before writing any of them
+        with "atomic": true (default) it should write all items or none of them,
+            with "atomic": false it should write the valid items and report the others
+    returns status code 200 and json {"success": True, "results": results} where results has one
+        {"index", "status", "id" or "error"} entry per item
+        or status code 400 with the per-item results if an atomic payload has invalid items
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @transactional
+    @idempotent
+    def bulk_create_actors(jwt):
+        items, atomic = bulk_args('actors')
+        try:
+            results, written = bulk_create(Actor, items, atomic)
+        except:
+            abort(422)
+        return bulk_response(results, written)
+
+    '''
+    PATCH /actors/bulk
+        it should update one row per item of {"actors": [...]}, each item holding
+            the actor id and the fields to change
+        it should require the 'patch:actors' permission
+        it should support "atomic" like POST /actors/bulk
+    returns the same shape as POST /actors/bulk, unknown ids are reported with status 404
+    '''
+    @APP.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    @transactional
+    def bulk_update_actors(jwt):
+        items, atomic = bulk_args('actors')
+        try:
+            results, written = bulk_update(Actor, items, atomic)
+        except:
+            abort(422)
+        return bulk_response(results, written)
+
+    '''
+    DELETE /actors/bulk
+        it should delete the rows listed in {"ids": [...]}
+        it should require the 'delete:actors' permission
+        it should support "atomic" like POST /actors/bulk
+    returns the same shape as POST /actors/bulk, unknown ids are reported with status 404
+    '''
+    @APP.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    @transactional
+    def bulk_delete_actors(jwt):
+        ids, atomic = bulk_args('ids')
+        try:
+            results, written = bulk_delete(Actor, ids, atomic)
+        except:
+            abort(422)
+        return bulk_response(results, written)
+
+    '''
+    POST /movies/import
+    POST /actors/import
+        it should queue the import of a csv or ndjson file of movies (or actors) and return right away
+        it should require the 'post:movies' (or 'post:actors') permission
+        the file is the request body, or the `file` field of a multipart form, with the columns
+            (keys) of POST /movies (or POST /actors). its type comes from the `type` query parameter
+            ('csv' or 'ndjson'), the content type or the file name
+        it should respond with 400 for an unknown type and 413 for a file over IMPORT_MAX_BYTES
+    returns status code 202 and json {"success": True, "jobs": [job]} with a Location header, the job's
+        url (see GET /jobs/<id>)
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/movies/import', methods=['POST'])
+    @requires_auth('post:movies')
+    @transactional
+    def import_movies(jwt):
+        return import_response(submit_import(Movie, jwt.get('sub')))
+
+    @APP.route('/actors/import', methods=['POST'])
+    @requires_auth('post:actors')
+    @transactional
+    def import_actors(jwt):
+        return import_response(submit_import(Actor, jwt.get('sub')))
+
+    '''
+    GET /jobs/<id>
+        where <id> is the id returned by POST /movies/import or POST /actors/import
+        it should require a valid token, then the 'get:movies' (or 'get:actors') permission, after the target of the job
+        it should respond with a 404 error if <id> is not found
+    returns status code 200 and json {"success": True, "jobs": [job]} where job holds its status (queued, running,
+        succeeded, failed), the rows read, imported and failed so far, the rows per second, the first rows that
+        could not be imported with their line number and why, and the message of a failed job
+    '''
+    @APP.route('/jobs/<job_id>', methods=['GET'])
+    # the job is looked up once the token is verified, so whether it exists
+    # is not told to callers without one
+    @requires_auth(lambda job_id: f'get:{find_job(job_id).target}')
+    def get_job(jwt, job_id):
+        job = find_job(job_id)
+        return jsonify({
+            'success': True,
+            'jobs': [job.format()]
+        }), 200
+
+    '''
+    GET /changes
+        it should be a public endpoint
+        it should accept the optional query parameters
+            since: the seq of the last change seen (or the Last-Event-ID header), defaults to 0
+            limit: number of changes per page (per event batch for a stream)
+        it should stream the changes as server-sent events, as they are committed, when the request
+            accepts text/event-stream (EventSource), for CHANGES_STREAM_TIMEOUT seconds
+    returns status code 200 and json {"success": True, "changes": changes, "next": seq} where changes are the
+        first changes to movies and actors after `since`, in commit order, each {"seq", "table", "id", "op", "data", "at"},
+        and seq the `since` value of the next page
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/changes', methods=['GET'])
+    def get_changes():
+        since, limit = change_args()
+        if request.accept_mimetypes.best_match(
+                ['application/json', 'text/event-stream']) == 'text/event-stream':
+            change_feed.start(APP.config['SQLALCHEMY_DATABASE_URI'])
+            return Response(stream_with_context(change_events(since, limit)),
+                            status=200, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache',
+                                     'X-Accel-Buffering': 'no'})
+
+        try:
+            changes = read_changes(since, limit)
+
+            return json_response({
+                'success': True,
+                'changes': changes,
+                'next': changes[-1]['seq'] if changes else since
+            }, 200)
+        except:
+            abort(422)
+
+    '''
+    GET /stats/movies
+        it should be a public endpoint
+        responses are cached until a movie or actor is written, and answer If-None-Match / If-Modified-Since
+        it should accept the limit, after, order and filter query parameters of GET /movies
+    returns status code 200 and json {"success": True, "movies": movies, "next": cursor} where movies is one page
+        of movies, each with "actors", the number of actors in its cast
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/stats/movies', methods=['GET'])
+    @conditional(('movies', 'actors'))
+    @response_cache.cached(('movies', 'actors'))
+    def get_movie_stats():
+        listing = listing_args(Movie)._replace(fields=None, include=())
+        query = filter_query(Movie.query, Movie)
+        try:
+            movies, next_cursor = paginate(query, Movie, listing)
+            counts = cast_counts([movie['id'] for movie in movies])
+            for movie in movies:
+                movie['actors'] = counts.get(movie['id'], 0)
+
+            return json_response({
+                'success': True,
+                'movies': movies,
+                'next': next_cursor
+            }, 200)
+        except:
+            abort(422)
+
+    '''
+    GET /stats/actors
+        it should be a public endpoint
+        responses are cached until an actor is written, and answer If-None-Match / If-Modified-Since
+        it should accept the optional `movie_id` query parameter to only count the cast of that movie
+    returns status code 200 and json {"success": True, "actors": stats} where stats holds the total number
+        of actors and their distribution per gender and per age bucket (see stats.actor_distributions)
+        or appropriate status code indicating reason for failure
+    '''
+    @APP.route('/stats/actors', methods=['GET'])
+    @conditional(('actors',))
+    @response_cache.cached(('actors',))
+    def get_actor_stats():
+        movie_id = request.args.get('movie_id', None) or None
+        try:
+            movie_id = None if movie_id is None else int(movie_id)
+        except ValueError:
+            abort(400)
+        try:
+            return json_response({
+                'success': True,
+                'actors': actor_distributions(movie_id)
+            }, 200)
+        except:
+            abort(422)
+
     # Error Handling
     '''
     Example error handling for unprocessable entity
@@ -277,7 +780,23 @@ def create_app(test_config=None):
             'error': 404,
             'message': 'Resource not found'
         }), 404
+
+    @APP.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            'success': False,
+            'error': 409,
+            'message': 'Conflict'
+        }), 409
     
+    @APP.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'Payload too large'
+        }), 413
+
     @APP.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -286,6 +805,30 @@ def create_app(test_config=None):
             "message": "Unprocessable"
         }), 422
 
+    @APP.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'Too many requests'
+        })
+        response.status_code = 429
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+    @APP.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'Service unavailable'
+        })
+        response.status_code = 503
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
     @APP.errorhandler(AuthError)
     def handle_auth_error(ex):
         """
@@ -298,7 +841,32 @@ def create_app(test_config=None):
     return APP
 
 
-APP = create_app()
+'''
+APP
+    the app built by create_app() with the default settings, created on
+    first access rather than on import, so importing main (tests, the
+    flask CLI) builds nothing
+
+    `gunicorn main:APP` and `gunicorn "main:create_app()"` both work
+'''
+
+_app = None
+
+
+def get_app():
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+
+def __getattr__(name):
+    if name == 'APP':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    if AUTO_MIGRATE:
+        upgrade_schema(get_app())
+    get_app().run(host='0.0.0.0', port=8080, debug=True)
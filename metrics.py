@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() not in ('0', 'false', 'no')
+
+
+METRICS_ENABLED = _env_flag('METRICS_ENABLED', 'true')
+SERVER_TIMING_ENABLED = _env_flag('SERVER_TIMING_ENABLED', 'true')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+'''
+Histogram
+    cumulative prometheus histogram, `buckets` are the upper bounds
+'''
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            bucket_labels = _labels(labels + (('le', f'{bound:g}'),))
+            lines.append(f'{name}_bucket{{{bucket_labels}}} {count}')
+        bucket_labels = _labels(labels + (('le', '+Inf'),))
+        lines.append(f'{name}_bucket{{{bucket_labels}}} {self.count}')
+        lines.append(f'{name}_sum{{{_labels(labels)}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{_labels(labels)}}} {self.count}')
+        return lines
+
+
+'''
+RequestTiming
+    what one request spent its time on, kept in flask.g while it runs
+'''
+
+
+class RequestTiming:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.auth_seconds = None
+        self.auth_source = None
+
+    def server_timing(self, total):
+        """Value of the Server-Timing header, durations in milliseconds
+        """
+        parts = [f'db;dur={self.sql_seconds * 1000:.2f};desc="{self.sql_count} queries"']
+        if self.auth_seconds is not None:
+            parts.append(f'auth;dur={self.auth_seconds * 1000:.2f};desc="{self.auth_source}"')
+        parts.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(parts)
+
+
+def current_timing():
+    if not has_request_context():
+        return None
+    return g.get('request_timing')
+
+
+'''
+RequestMetrics
+    process-wide histograms, labelled by url rule (not by raw path, which
+    would make a series per id)
+
+    fsnd_http_request_duration_seconds{method, route, status}
+    fsnd_db_queries_per_request{method, route}: a route whose count grows
+        with the page size is an N+1
+    fsnd_db_query_duration_seconds{method, route}: time in SQL per request
+    fsnd_auth_duration_seconds{source}: token verification, where source is
+        cache (verified token cache hit), jwks (verified with the cached key
+        set) or jwks_fetch (the key set had to be fetched first)
+'''
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def _observe(self, name, labels, buckets, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_request(self, method, route, status, seconds, timing):
+        route_labels = (('method', method), ('route', route))
+        self._observe('fsnd_http_request_duration_seconds',
+                      route_labels + (('status', str(status)),),
+                      LATENCY_BUCKETS, seconds)
+        self._observe('fsnd_db_queries_per_request', route_labels,
+                      QUERY_COUNT_BUCKETS, timing.sql_count)
+        self._observe('fsnd_db_query_duration_seconds', route_labels,
+                      LATENCY_BUCKETS, timing.sql_seconds)
+
+    def observe_auth(self, seconds, source):
+        self._observe('fsnd_auth_duration_seconds', (('source', source),),
+                      LATENCY_BUCKETS, seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (histogram_name, labels), histogram in sorted(
+                        self._histograms.items()):
+                    if histogram_name == name:
+                        lines.extend(histogram.samples(name, labels))
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+request_metrics = RequestMetrics()
+
+
+def record_auth(seconds, source):
+    """Records one token verification (see auth.requires_auth)
+    """
+    timing = current_timing()
+    if timing is not None:
+        timing.auth_seconds = seconds
+        timing.auth_source = source
+    if METRICS_ENABLED:
+        request_metrics.observe_auth(seconds, source)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    timing = current_timing()
+    if timing is not None:
+        timing.sql_count += 1
+        timing.sql_seconds += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'handle_error')
+def _cursor_execute_failed(context):
+    starts = context.connection.info.get('query_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+
+'''
+render_stats(prefix, stats)
+    prometheus lines for the numeric values of a stats dict
+    (e.g. pool_metrics.stats()), one `<prefix>_<key>` gauge each
+'''
+
+
+def render_stats(prefix, stats):
+    lines = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines.append(f'# TYPE {prefix}_{key} gauge')
+            lines.append(f'{prefix}_{key} {value}')
+    return lines
+
+
+'''
+init_app(app)
+    times every request of `app`: its latency, SQL and auth time are added
+    to request_metrics and sent back in a Server-Timing header
+
+    the time of a streamed body (exports) is not included, the response
+    has left the view before it is sent
+'''
+
+
+def init_app(app):
+    @app.before_request
+    def start_request_timing():
+        g.request_timing = RequestTiming()
+
+    @app.after_request
+    def finish_request_timing(response):
+        timing = current_timing()
+        if timing is None:
+            return response
+
+        total = time.perf_counter() - timing.start
+        if SERVER_TIMING_ENABLED:
+            response.headers['Server-Timing'] = timing.server_timing(total)
+        if METRICS_ENABLED:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            request_metrics.observe_request(request.method, route,
+                                            response.status_code, total, timing)
+        return response
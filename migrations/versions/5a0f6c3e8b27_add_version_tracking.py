@@ -0,0 +1,48 @@
+"""add version tracking
+
+Revision ID: 5a0f6c3e8b27
+Revises: e7d3b5a90c62
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a0f6c3e8b27'
+down_revision = 'e7d3b5a90c62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sqlite cannot add a column with a non-constant default in place
+    recreate = 'always' if op.get_bind().dialect.name == 'sqlite' else 'auto'
+    for table in ('movies', 'actors'):
+        with op.batch_alter_table(table, recreate=recreate) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(),
+                                          nullable=False,
+                                          server_default=sa.func.now()))
+
+    versions = op.create_table(
+        'collection_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(versions, [
+        {'name': 'movies', 'version': 0, 'updated_at': now},
+        {'name': 'actors', 'version': 0, 'updated_at': now}
+    ])
+
+
+def downgrade():
+    op.drop_table('collection_versions')
+    for table in ('actors', 'movies'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,33 @@
+"""add lookup indexes
+
+Revision ID: 8b4e2d6f0a31
+Revises: 3f1c9a2b7d10
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e2d6f0a31'
+down_revision = '3f1c9a2b7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (movie_id, id) serves both the foreign key lookups and cast listings
+    # ordered by id, so movie_id needs no index of its own
+    op.create_index('ix_actors_movie_id_id', 'actors', ['movie_id', 'id'])
+    op.create_index('ix_actors_name', 'actors', ['name'])
+    op.create_index('ix_actors_age', 'actors', ['age'])
+    op.create_index('ix_movies_title', 'movies', ['title'])
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_actors_movie_id_id', table_name='actors')
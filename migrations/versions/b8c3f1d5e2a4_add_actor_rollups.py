@@ -0,0 +1,52 @@
+"""add actor rollups
+
+Revision ID: b8c3f1d5e2a4
+Revises: 9d2b6e4f1a73
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from collections import Counter
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c3f1d5e2a4'
+down_revision = '9d2b6e4f1a73'
+branch_labels = None
+depends_on = None
+
+# the bucketing of model.rollup_key at the time of this migration
+AGE_BUCKET_WIDTH = 10
+UNKNOWN_GENDER = ''
+UNKNOWN_AGE = -1
+
+
+def upgrade():
+    rollups = op.create_table(
+        'actor_rollups',
+        sa.Column('gender', sa.String(), nullable=False),
+        sa.Column('age_bucket', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('actors', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('gender', 'age_bucket')
+    )
+
+    # counts the actors written before this migration
+    counts = Counter()
+    rows = op.get_bind().execute(sa.text(
+        'SELECT gender, age, count(*) FROM actors GROUP BY gender, age'))
+    for gender, age, count in rows:
+        if age is not None:
+            age = age // AGE_BUCKET_WIDTH * AGE_BUCKET_WIDTH
+        counts[(UNKNOWN_GENDER if gender is None else gender,
+                UNKNOWN_AGE if age is None else age)] += count
+    if counts:
+        op.bulk_insert(rollups, [
+            {'gender': gender, 'age_bucket': age_bucket, 'actors': count}
+            for (gender, age_bucket), count in sorted(counts.items())
+        ])
+
+
+def downgrade():
+    op.drop_table('actor_rollups')
@@ -0,0 +1,39 @@
+"""add search indexes
+
+Revision ID: c52a7e91d4b8
+Revises: 8b4e2d6f0a31
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c52a7e91d4b8'
+down_revision = '8b4e2d6f0a31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # lower(column) LIKE 'prefix%' and ILIKE '%text%' can only use these
+    # postgres index types, other databases fall back to the plain indexes
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX ix_movies_title_lower '
+               'ON movies (lower(title) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_movies_title_trgm '
+               'ON movies USING gin (title gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_actors_name_lower '
+               'ON actors (lower(name) text_pattern_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('DROP INDEX ix_actors_name_lower')
+    op.execute('DROP INDEX ix_movies_title_trgm')
+    op.execute('DROP INDEX ix_movies_title_lower')
@@ -0,0 +1,45 @@
+"""add import jobs
+
+Revision ID: d4a7e2c9b6f1
+Revises: b8c3f1d5e2a4
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7e2c9b6f1'
+down_revision = 'b8c3f1d5e2a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'import_jobs',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('target', sa.String(), nullable=False),
+        sa.Column('file_type', sa.String(), nullable=False),
+        sa.Column('path', sa.String(), nullable=False),
+        sa.Column('owner', sa.String(), nullable=True),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('rows_read', sa.BigInteger(), nullable=False),
+        sa.Column('rows_imported', sa.BigInteger(), nullable=False),
+        sa.Column('rows_failed', sa.BigInteger(), nullable=False),
+        sa.Column('errors', sa.Text(), nullable=True),
+        sa.Column('message', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_import_jobs_status_created_at', 'import_jobs',
+                    ['status', 'created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_import_jobs_status_created_at', table_name='import_jobs')
+    op.drop_table('import_jobs')
@@ -0,0 +1,81 @@
+"""store movies.release_date as a date
+
+Revision ID: e7d3b5a90c62
+Revises: c52a7e91d4b8
+Create Date: 2026-10-18 11:30:00.000000
+
+"""
+import logging
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7d3b5a90c62'
+down_revision = 'c52a7e91d4b8'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+BATCH_SIZE = 1000
+
+
+def _parse(value):
+    try:
+        return date.fromisoformat(value.strip()[:10])
+    except (AttributeError, ValueError):
+        return None
+
+
+def _copy_in_batches(bind, source, target, convert):
+    movies = sa.table('movies', sa.column('id'), sa.column(source),
+                      sa.column(target))
+    update = movies.update() \
+        .where(movies.c.id == sa.bindparam('movie_id')) \
+        .values({target: sa.bindparam('value')})
+
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(movies.c.id, movies.c[source])
+            .where(movies.c.id > last_id)
+            .order_by(movies.c.id)
+            .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        values = []
+        for movie_id, value in rows:
+            converted = convert(value)
+            if value is not None and converted is None:
+                logger.warning('movie %s: dropping release_date %r, '
+                               'not an ISO-8601 date', movie_id, value)
+            values.append({'movie_id': movie_id, 'value': converted})
+        bind.execute(update, values)
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('release_on', sa.Date(), nullable=True))
+    _copy_in_batches(op.get_bind(), 'release_date', 'release_on', _parse)
+
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('release_date')
+        batch_op.alter_column('release_on', new_column_name='release_date')
+    op.create_index('ix_movies_release_date', 'movies', ['release_date', 'id'])
+
+
+def downgrade():
+    op.add_column('movies', sa.Column('release_text', sa.String(), nullable=True))
+    _copy_in_batches(op.get_bind(), 'release_date', 'release_text',
+                     lambda value: None if value is None else str(value))
+
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('release_date')
+        batch_op.alter_column('release_text', new_column_name='release_date')
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
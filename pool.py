@@ -0,0 +1,219 @@
+import functools
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() not in ('0', 'false', 'no')
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = _env_flag('DB_POOL_PRE_PING', 'true')
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+DB_PGBOUNCER = _env_flag('DB_PGBOUNCER', 'false')
+
+# weight of the latest checkout in wait_seconds_recent
+RECENT_WAIT_WEIGHT = 0.2
+# seconds after which wait_seconds_recent has halved without checkouts
+RECENT_WAIT_HALF_LIFE = float(os.environ.get('DB_POOL_WAIT_HALF_LIFE', 5))
+
+
+'''
+PoolMetrics
+    process-wide counters for the connection pool of the primary database
+    (the replicas' pools are not metered, see engine_options)
+
+    wait time is the time spent getting a connection out of the pool,
+    including opening a new one when the pool has room for it.
+    wait_seconds_recent is a moving average that follows the latest
+    checkouts and decays with time (RECENT_WAIT_HALF_LIFE), so it falls
+    back to 0 when nothing is checked out (see ratelimit.LoadShedder)
+'''
+
+
+class PoolMetrics:
+    def __init__(self, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._engine = None
+        self.reset()
+
+    def attach(self, engine):
+        """Reports the pool of `engine`, the primary of the serving app (see
+        model.setup_for_db), whichever other metered pools exist
+        """
+        self._engine = engine
+
+    @property
+    def pool(self):
+        # read through the engine, dispose() replaces its pool
+        return self._engine.pool if self._engine is not None else None
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkins = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+            self._recent_wait = 0.0
+            self._recent_at = self._clock()
+
+    def _decayed_wait(self, now):
+        return self._recent_wait * \
+            0.5 ** ((now - self._recent_at) / RECENT_WAIT_HALF_LIFE)
+
+    @property
+    def wait_seconds_recent(self):
+        with self._lock:
+            return self._decayed_wait(self._clock())
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            now = self._clock()
+            recent = self._decayed_wait(now)
+            self._recent_wait = recent + RECENT_WAIT_WEIGHT * (seconds - recent)
+            self._recent_at = now
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def checked_out(self):
+        """Connections of the pool currently in use
+        """
+        if isinstance(self.pool, QueuePool):
+            return self.pool.checkedout()
+        # NullPool (PgBouncer) connections are opened per checkout
+        return max(0, self.checkouts - self.checkins)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+                'wait_seconds_max': round(self.wait_seconds_max, 6),
+                'wait_seconds_recent': round(self._decayed_wait(self._clock()), 6),
+                'wait_seconds_avg': round(
+                    self.wait_seconds_total / self.checkouts, 6)
+                if self.checkouts else 0.0
+            }
+
+        if isinstance(self.pool, QueuePool):
+            stats.update({
+                'size': self.pool.size(),
+                'checked_out': self.pool.checkedout(),
+                'overflow': self.pool.overflow(),
+                'idle': self.pool.checkedin()
+            })
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+class _MeteredPool:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # listened to per pool: SQLAlchemy 1.4.18 cannot listen on the
+        # asyncio pool classes themselves
+        for name, counter in (('checkout', 'checkouts'), ('checkin', 'checkins'),
+                              ('connect', 'connects'),
+                              ('invalidate', 'invalidations')):
+            event.listen(self, name, functools.partial(_count, counter))
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.increment('timeouts')
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - start)
+
+
+def _count(counter, *args):
+    pool_metrics.increment(counter)
+
+
+class MeteredQueuePool(_MeteredPool, QueuePool):
+    pass
+
+
+class MeteredAsyncAdaptedQueuePool(_MeteredPool, AsyncAdaptedQueuePool):
+    pass
+
+
+class MeteredNullPool(_MeteredPool, NullPool):
+    pass
+
+
+'''
+engine_options(database_path, metered)
+    SQLAlchemy engine options for `database_path`, read from the environment
+
+    with `metered` the pool reports to pool_metrics, which /status, /metrics
+    and the load shedder read as the primary's: only its engine is metered
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT: per worker pool sizing
+    DB_POOL_RECYCLE: seconds after which a connection is replaced
+    DB_POOL_PRE_PING: test connections on checkout, so connections left
+        over from a failover are replaced instead of failing the request
+    DB_STATEMENT_TIMEOUT_MS: postgres statement_timeout, 0 disables it
+    DB_PGBOUNCER: the url points at PgBouncer in transaction mode, connections
+        are not pooled in the app and no startup parameters are sent
+        (set statement_timeout on the PgBouncer database or role instead)
+
+    asyncpg urls (postgresql+asyncpg://) get the asyncio flavour of the pool
+'''
+
+
+def engine_options(database_path, metered=True):
+    if database_path.startswith('sqlite'):
+        return {}
+
+    asyncpg = database_path.startswith('postgresql+asyncpg')
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    if DB_PGBOUNCER:
+        options['poolclass'] = MeteredNullPool if metered else NullPool
+        if asyncpg:
+            # prepared statements do not survive PgBouncer's transaction mode
+            options['connect_args'] = {'statement_cache_size': 0}
+        return options
+
+    if metered:
+        poolclass = MeteredAsyncAdaptedQueuePool if asyncpg else MeteredQueuePool
+    else:
+        poolclass = AsyncAdaptedQueuePool if asyncpg else QueuePool
+    options.update({
+        'poolclass': poolclass,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE
+    })
+    if DB_STATEMENT_TIMEOUT_MS and asyncpg:
+        options['connect_args'] = {
+            'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT_MS)}
+        }
+    elif DB_STATEMENT_TIMEOUT_MS and database_path.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
+        }
+    return options
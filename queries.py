@@ -0,0 +1,249 @@
+import os
+from collections import namedtuple
+from datetime import date
+from flask import request, abort
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+
+from model import parse_date
+from serializers import dumps, row_dicts
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+
+def _int_arg(name, default=None):
+    value = request.args.get(name, None)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def field_args(model):
+    requested = request.args.get('fields', None)
+    if not requested:
+        return None
+
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    if any(name not in model.FIELDS for name in names):
+        abort(400)
+    return ['id'] + [name for name in model.FIELDS
+                     if name in names and name != 'id']
+
+
+def include_args(model):
+    requested = request.args.get('include', None)
+    if not requested:
+        return ()
+
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    if any(name not in model.INCLUDES for name in names):
+        abort(400)
+    return tuple(names)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+'''
+filter operators
+    each one builds an SQL predicate from a column and a parsed value
+
+    prefix: case-insensitive `lower(column) LIKE 'value%'`, served by the
+        lower(column) text_pattern_ops indexes on postgres
+    search: case-insensitive substring match, served by the pg_trgm indexes
+        on postgres
+'''
+
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'gte': lambda column, value: column >= value,
+    'lte': lambda column, value: column <= value,
+    'prefix': lambda column, value: func.lower(column).like(
+        _escape_like(value.lower()) + '%', escape='\\'),
+    'search': lambda column, value: column.ilike(
+        '%' + _escape_like(value) + '%', escape='\\'),
+}
+
+
+def _parse_value(model, name, value):
+    python_type = model.__table__.c[name].type.python_type
+    if python_type is str:
+        return value
+    try:
+        if python_type is date:
+            return parse_date(value)
+        return python_type(value)
+    except ValueError:
+        abort(400)
+
+
+'''
+filter_query(query, model)
+    narrows `query` with the filters of the current request
+
+    model.FILTERS maps a query parameter to a (column name, operator) pair,
+    values are parsed to the column type and compiled to SQL predicates
+    aborts with 400 on a value that cannot be parsed
+'''
+
+
+def filter_query(query, model):
+    for param, (name, operator) in model.FILTERS.items():
+        value = request.args.get(param, None)
+        if value is None or value == '':
+            continue
+
+        column = getattr(model, name)
+        value = _parse_value(model, name, value)
+        query = query.filter(FILTER_OPERATORS[operator](column, value))
+    return query
+
+
+Listing = namedtuple('Listing', ['limit', 'after', 'fields', 'include', 'order'])
+
+
+def _cursor_arg(model, order):
+    if order is None:
+        return _int_arg('after')
+
+    value = request.args.get('after', None)
+    if not value:
+        return None
+    key, _, after_id = value.rpartition(',')
+    try:
+        return _parse_value(model, order, key), int(after_id)
+    except ValueError:
+        abort(400)
+
+
+'''
+listing_args(model)
+    reads and validates the list arguments of the current request
+
+    limit: page size, defaults to DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE
+    order: one of model.ORDERINGS, rows are ordered by (order, id) and rows
+        without a value for it are left out. defaults to ordering by id
+    after: keyset cursor, the `next` value of the previous page
+        (an id, or "<value>,<id>" when ordering by another column)
+    fields: comma separated subset of model.FIELDS, `id` and the order
+        column are always included
+    include: comma separated subset of model.INCLUDES, related rows to embed
+        (cannot be combined with fields)
+
+    aborts with 400 on an invalid argument
+'''
+
+
+def listing_args(model):
+    limit = _int_arg('limit', DEFAULT_PAGE_SIZE)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    order = request.args.get('order', None) or None
+    if order is not None and order not in model.ORDERINGS:
+        abort(400)
+
+    after = _cursor_arg(model, order)
+    fields = field_args(model)
+    include = include_args(model)
+    if fields and include:
+        abort(400)
+    if fields and order and order not in fields:
+        fields.append(order)
+
+    return Listing(limit, after, fields, include, order)
+
+
+'''
+eager_load(query, model, include)
+    loads the related rows named in `include` with a fixed number of queries:
+    collections through one extra SELECT ... IN per page (selectinload),
+    many-to-one relations through a JOIN on the same query (joinedload)
+'''
+
+
+def eager_load(query, model, include):
+    for name in include:
+        relation = getattr(model, name)
+        if relation.property.uselist:
+            query = query.options(selectinload(relation))
+        else:
+            query = query.options(joinedload(relation))
+    return query
+
+
+'''
+paginate(query, model, listing)
+    runs one keyset page of `query` as described by `listing` (see listing_args)
+
+    rows are read as plain column tuples (`listing.fields`, or all of
+    model.FIELDS) without building ORM objects. only when related rows are
+    embedded (`listing.include`) are full objects loaded and serialized
+    through model.format(include)
+returns (items, next_cursor) where next_cursor is None on the last page
+'''
+
+
+def paginate(query, model, listing):
+    fields = None
+    if listing.include:
+        query = eager_load(query, model, listing.include)
+    else:
+        fields = listing.fields or list(model.FIELDS)
+        query = query.with_entities(*[getattr(model, name) for name in fields])
+
+    if listing.order:
+        # (order, id) row comparison, served by the (order, id) index
+        column = getattr(model, listing.order)
+        query = query.filter(column.isnot(None)).order_by(column, model.id)
+        if listing.after is not None:
+            query = query.filter(tuple_(column, model.id) > listing.after)
+    else:
+        query = query.order_by(model.id)
+        if listing.after is not None:
+            query = query.filter(model.id > listing.after)
+
+    rows = query.limit(listing.limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > listing.limit:
+        rows = rows[:listing.limit]
+        next_cursor = rows[-1].id
+        if listing.order:
+            value = getattr(rows[-1], listing.order)
+            if isinstance(value, date):
+                value = value.isoformat()
+            next_cursor = f'{value},{next_cursor}'
+
+    if fields:
+        items = row_dicts(fields, rows)
+    else:
+        items = [row.format(listing.include) for row in rows]
+    return items, next_cursor
+
+
+'''
+export_rows(query, model, fields)
+    yields every row of `query` ordered by id as one line of json
+
+    rows are read through a server-side cursor in batches of EXPORT_BATCH_SIZE
+    and only the selected columns are loaded, so memory use does not depend
+    on the number of rows
+'''
+
+
+def export_rows(query, model, fields=None):
+    fields = fields or list(model.FIELDS)
+    query = query.with_entities(*[getattr(model, name) for name in fields]) \
+        .order_by(model.id) \
+        .yield_per(EXPORT_BATCH_SIZE)
+
+    for row in query:
+        yield dumps(dict(zip(fields, row))) + b'\n'
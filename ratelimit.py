@@ -0,0 +1,267 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from pool import DB_POOL_SIZE, DB_MAX_OVERFLOW, pool_metrics
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, default).lower() not in ('0', 'false', 'no')
+
+
+RATE_LIMIT_ENABLED = _env_flag('RATE_LIMIT_ENABLED', 'true')
+# <requests>/<seconds> per client, for every write permission (post:, patch:, delete:)
+RATE_LIMIT_DEFAULT = os.environ.get('RATE_LIMIT_DEFAULT', '120/60')
+# per permission quotas, e.g. "delete:movies=10/60,post:actors=600/60",
+# a quota of 0 requests turns the limit off for that permission
+RATE_LIMITS = os.environ.get('RATE_LIMITS', '')
+# the token claim a client is known by: sub (the user, or the client id of
+# a machine to machine token) or azp (the application)
+RATE_LIMIT_KEY = os.environ.get('RATE_LIMIT_KEY', 'sub')
+RATE_LIMIT_URL = os.environ.get('RATE_LIMIT_URL', None)
+RATE_LIMIT_SIZE = int(os.environ.get('RATE_LIMIT_SIZE', 10000))
+
+LOAD_SHED_ENABLED = _env_flag('LOAD_SHED_ENABLED', 'true')
+LOAD_SHED_POOL_WAIT = float(os.environ.get('LOAD_SHED_POOL_WAIT', 0.25))
+# connections of the worker's pool in use (requests and background work)
+# below which writes are never shed, by default a saturated pool
+LOAD_SHED_CHECKED_OUT = int(os.environ.get('LOAD_SHED_CHECKED_OUT',
+                                           DB_POOL_SIZE + DB_MAX_OVERFLOW))
+LOAD_SHED_RETRY_AFTER = int(os.environ.get('LOAD_SHED_RETRY_AFTER', 1))
+
+WRITE_PREFIXES = ('post:', 'patch:', 'delete:')
+
+
+def parse_quota(value):
+    """'<requests>/<seconds>' as (requests, seconds), None for 0 requests
+    """
+    requests, _, seconds = value.partition('/')
+    requests, seconds = int(requests), float(seconds or 1)
+    if requests < 0 or seconds <= 0:
+        raise ValueError(f'Invalid rate limit: {value!r}')
+    return (requests, seconds) if requests else None
+
+
+def parse_quotas(value):
+    quotas = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        permission, _, quota = item.partition('=')
+        quotas[permission.strip()] = parse_quota(quota.strip())
+    return quotas
+
+
+'''
+LocalRateLimitBackend
+    token buckets kept in process, one per client and permission
+
+    a bucket holds `capacity` tokens and gains one every period / capacity
+    seconds, a request takes one. it is stored as the time the bucket will
+    be full again (GCRA), so refilling needs no timer. the least recently
+    used buckets beyond `maxsize` are dropped, i.e. refilled.
+
+    like the response cache, every gunicorn worker has its own buckets, so
+    a client gets up to the quota per worker; use a shared backend to avoid
+    that
+'''
+
+
+class LocalRateLimitBackend:
+    def __init__(self, maxsize=RATE_LIMIT_SIZE, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._full_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """Takes a token, returns 0 or the seconds until one is available
+        """
+        interval = period / capacity
+        with self._lock:
+            now = self.clock()
+            full_at = max(self._full_at.get(key, now), now)
+            # the bucket is empty when it is full again in a whole period
+            wait = full_at + interval - period - now
+            if wait > 0:
+                return wait
+            self._full_at[key] = full_at + interval
+            self._full_at.move_to_end(key)
+            while len(self._full_at) > self.maxsize:
+                self._full_at.popitem(last=False)
+            return 0.0
+
+    def clear(self):
+        with self._lock:
+            self._full_at.clear()
+
+
+'''
+RedisRateLimitBackend
+    the same token buckets shared by every worker, stored in redis and
+    updated atomically by a lua script
+
+    `client` is anything with the eval method of redis.Redis, by default
+    one is created from `url` (the redis package is only needed then)
+'''
+
+_TAKE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local period = tonumber(ARGV[3])
+local interval = period / capacity
+local full_at = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+local wait = full_at + interval - period - now
+if wait > 0 then
+    return tostring(wait)
+end
+redis.call('SET', KEYS[1], tostring(full_at + interval),
+           'PX', math.ceil((full_at + interval - now) * 1000))
+return '0'
+'''
+
+
+class RedisRateLimitBackend:
+    def __init__(self, url=RATE_LIMIT_URL, client=None, prefix='fsnd:rate:',
+                 clock=time.time):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def take(self, key, capacity, period):
+        return float(self.client.eval(_TAKE_SCRIPT, 1, self.prefix + key,
+                                      repr(self.clock()), capacity, period))
+
+    def clear(self):
+        pass
+
+
+'''
+RateLimiter
+    per client quotas for the permissions checked by auth.requires_auth
+
+    write permissions get RATE_LIMIT_DEFAULT unless RATE_LIMITS names them,
+    other permissions are only limited when RATE_LIMITS names them.
+    a client over its quota is answered with 429 and a Retry-After header
+'''
+
+
+class RateLimiter:
+    def __init__(self, backend=None, default=RATE_LIMIT_DEFAULT,
+                 quotas=RATE_LIMITS, key_claim=RATE_LIMIT_KEY,
+                 enabled=RATE_LIMIT_ENABLED):
+        self.backend = backend or LocalRateLimitBackend()
+        self.default = parse_quota(default)
+        self.quotas = parse_quotas(quotas)
+        self.key_claim = key_claim
+        self.enabled = enabled
+        self.allowed = 0
+        self.limited = 0
+
+    def quota(self, permission):
+        if permission in self.quotas:
+            return self.quotas[permission]
+        if permission.startswith(WRITE_PREFIXES):
+            return self.default
+        return None
+
+    def check(self, permission, payload):
+        quota = self.quota(permission) if self.enabled else None
+        if quota is None:
+            return
+
+        client = payload.get(self.key_claim) or payload.get('sub', '')
+        wait = self.backend.take(f'{client}:{permission}', *quota)
+        if wait > 0:
+            self.limited += 1
+            raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+        self.allowed += 1
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'allowed': self.allowed,
+            'limited': self.limited
+        }
+
+
+'''
+LoadShedder
+    turns writes away before they ask for a connection, while the database
+    is the bottleneck
+
+    a write is answered with 503 and Retry-After when connections have
+    recently waited more than LOAD_SHED_POOL_WAIT seconds on average to get
+    out of the pool (pool_metrics.wait_seconds_recent) and at least
+    LOAD_SHED_CHECKED_OUT of them are in use. both are read from the pool,
+    which every thread, task and import worker of the process shares: a
+    count of the requests in flight would never grow past one under the
+    sync workers. with a pool that keeps up, writes are never shed, and
+    shedding stops once the pool has room again or the wait has decayed
+'''
+
+
+class LoadShedder:
+    def __init__(self, checked_out=LOAD_SHED_CHECKED_OUT,
+                 pool_wait=LOAD_SHED_POOL_WAIT, enabled=LOAD_SHED_ENABLED,
+                 metrics=pool_metrics):
+        self.checked_out = checked_out
+        self.pool_wait = pool_wait
+        self.enabled = enabled
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.shed = 0
+
+    def overloaded(self):
+        return self.metrics.wait_seconds_recent >= self.pool_wait and \
+            self.metrics.checked_out() >= self.checked_out
+
+    @contextmanager
+    def admit(self):
+        with self._lock:
+            if self.enabled and self.overloaded():
+                self.shed += 1
+                raise ServiceUnavailable(retry_after=LOAD_SHED_RETRY_AFTER)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'in_flight': self.in_flight,
+            'shed': self.shed
+        }
+
+
+rate_limiter = RateLimiter(
+    RedisRateLimitBackend() if RATE_LIMIT_URL else LocalRateLimitBackend())
+load_shedder = LoadShedder()
+
+
+'''
+limit(permission, payload)
+    context manager around a request authorized for `permission` by a
+    token with claims `payload`: checks the client's quota and, for write
+    permissions, admits the request past the load shedder
+'''
+
+
+@contextmanager
+def limit(permission, payload):
+    rate_limiter.check(permission, payload)
+    if not permission.startswith(WRITE_PREFIXES):
+        yield
+        return
+    with load_shedder.admit():
+        yield
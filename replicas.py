@@ -0,0 +1,176 @@
+import itertools
+import os
+import time
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+
+from pool import engine_options
+
+# comma separated, e.g. postgresql://reader@replica-1/fsnd,postgresql://reader@replica-2/fsnd
+REPLICA_URLS = [url.strip().replace('postgres://', 'postgresql://', 1)
+                for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 10))
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+BIND_PREFIX = 'replica_'
+
+PRIMARY = 'primary'
+
+_LAG_QUERY = text(
+    'SELECT CASE WHEN NOT pg_is_in_recovery() '
+    'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for the replica `urls`
+    """
+    return {f'{BIND_PREFIX}{index}': dict(engine_options(url, metered=False), url=url)
+            for index, url in enumerate(urls)}
+
+
+def replica_lag(engine):
+    """Seconds the replica behind `engine` is behind its primary
+
+    a replica that has replayed everything it received is not behind, even
+    when nothing was written for a while. databases other than postgres
+    are stand-ins (tests) and never lag
+    """
+    with engine.connect() as connection:
+        if engine.dialect.name != 'postgresql':
+            connection.execute(text('SELECT 1'))
+            return 0.0
+        return float(connection.execute(_LAG_QUERY).scalar() or 0.0)
+
+
+'''
+ReplicaSet
+    health of the read replicas of this worker
+
+    a replica is checked (connection and replication lag) when it is picked
+    and its last check is older than `interval` seconds. it is used while it
+    answers and lags at most `max_lag` seconds, otherwise reads fall back to
+    the primary until a later check succeeds. healthy replicas are used in
+    turn
+'''
+
+
+class ReplicaSet:
+    def __init__(self, check=replica_lag, max_lag=DB_REPLICA_MAX_LAG,
+                 interval=DB_REPLICA_CHECK_INTERVAL):
+        self._check = check
+        self.max_lag = max_lag
+        self.interval = interval
+        self._state = {}
+        self._turn = itertools.count()
+        self.routed = 0
+        self.fallbacks = 0
+        self.checks = 0
+        self.check_errors = 0
+
+    def _probe(self, key, engine):
+        self.checks += 1
+        try:
+            lag = self._check(engine)
+        except Exception:
+            # unreachable, reads go to the primary until the next check
+            self.check_errors += 1
+            lag = None
+        state = self._state[key] = {'checked_at': time.monotonic(), 'lag': lag}
+        return state
+
+    def healthy(self, engines):
+        """Bind keys of the replicas in `engines` that can take reads
+        """
+        now = time.monotonic()
+        keys = []
+        for key in sorted(key for key in engines
+                          if key is not None and key.startswith(BIND_PREFIX)):
+            state = self._state.get(key)
+            if state is None or now - state['checked_at'] >= self.interval:
+                state = self._probe(key, engines[key])
+            if state['lag'] is not None and state['lag'] <= self.max_lag:
+                keys.append(key)
+        return keys
+
+    def choose(self, engines):
+        """Bind key of the replica to read from, None for the primary
+        """
+        keys = self.healthy(engines)
+        if not keys:
+            self.fallbacks += 1
+            return None
+        self.routed += 1
+        return keys[next(self._turn) % len(keys)]
+
+    def clear(self):
+        self._state.clear()
+
+    def stats(self):
+        lags = [state['lag'] for state in self._state.values()]
+        return {
+            'replicas': len(self._state),
+            'healthy': sum(1 for lag in lags
+                           if lag is not None and lag <= self.max_lag),
+            'lag_seconds_max': max((lag for lag in lags if lag is not None),
+                                   default=0.0),
+            'routed': self.routed,
+            'fallbacks': self.fallbacks,
+            'checks': self.checks,
+            'check_errors': self.check_errors
+        }
+
+
+replica_set = ReplicaSet()
+
+
+'''
+RoutingSession
+    db.session, sends the reads of safe requests (GET, HEAD, OPTIONS) to a
+    replica and everything else to the primary
+
+    a request sticks to the database it first read from. once it writes
+    (pending objects, a flush, a DML statement, a unit of work) the rest of
+    it goes to the primary, so it reads its own writes. outside of a request
+    (migrations, scripts, tests) the primary is used
+'''
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            key = self._route(clause)
+            if key != PRIMARY:
+                return self._db.engines[key]
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+    def _writes(self, clause):
+        return self._flushing or self.new or self.dirty or self.deleted or \
+            self.info.get('unit_of_work') or self.info.get('changed_tables') or \
+            getattr(clause, 'is_dml', False)
+
+    def _route(self, clause):
+        route = g.get('db_route')
+        if route == PRIMARY:
+            return route
+        if request.method not in SAFE_METHODS or self._writes(clause):
+            route = PRIMARY
+        elif route is None:
+            route = replica_set.choose(self._db.engines) or PRIMARY
+        g.db_route = route
+        return route
+
+
+'''
+init_app(app)
+    resets the routing of every request of `app`
+'''
+
+
+def init_app(app):
+    @app.before_request
+    def reset_db_route():
+        g.db_route = None
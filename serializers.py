@@ -0,0 +1,55 @@
+import json
+import os
+from datetime import date
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# auto uses orjson when it is installed, stdlib forces the json module
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_default)
+
+
+def backend_name():
+    if JSON_BACKEND != 'stdlib' and orjson is not None:
+        return 'orjson'
+    return 'stdlib'
+
+
+'''
+dumps(obj)
+    encodes `obj` to json bytes with the configured backend
+    dates are written as ISO-8601 strings by both backends
+'''
+
+
+def dumps(obj):
+    if backend_name() == 'orjson':
+        return _orjson_dumps(obj)
+    return _stdlib_dumps(obj)
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def row_dicts(fields, rows):
+    """Turns column tuples (as returned by query.with_entities) into dicts
+    """
+    return [dict(zip(fields, row)) for row in rows]
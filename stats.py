@@ -0,0 +1,71 @@
+from collections import Counter
+from sqlalchemy import func
+
+from model import db, Actor, ActorRollup, AGE_BUCKET_WIDTH, UNKNOWN_GENDER, UNKNOWN_AGE, rollup_key
+
+
+def cast_counts(movie_ids):
+    """{movie id: number of actors} of the movies `movie_ids` (those without
+    actors are left out), one GROUP BY served by the (movie_id, id) index
+    """
+    if not movie_ids:
+        return {}
+    rows = db.session.query(Actor.movie_id, func.count(Actor.id)) \
+        .filter(Actor.movie_id.in_(movie_ids)) \
+        .group_by(Actor.movie_id)
+    return dict(rows.all())
+
+
+def _stored_rollups():
+    return Counter({(row.gender, row.age_bucket): row.actors
+                    for row in ActorRollup.query})
+
+
+def _cast_rollups(movie_id):
+    counts = Counter()
+    rows = db.session.query(Actor.gender, Actor.age, func.count(Actor.id)) \
+        .filter(Actor.movie_id == movie_id) \
+        .group_by(Actor.gender, Actor.age)
+    for gender, age, count in rows:
+        counts[rollup_key(gender, age)] += count
+    return counts
+
+
+def _sort_last(value, unknown):
+    return (value == unknown, value)
+
+
+'''
+actor_distributions(movie_id)
+    the number of actors per gender and per age bucket (AGE_BUCKET_WIDTH
+    years), of every actor or of the cast of `movie_id`
+
+    every actor: read from actor_rollups, whatever the size of the actors
+    table. a cast: grouped from its rows, found through the (movie_id, id)
+    index
+returns {"total": n, "genders": [{"gender", "actors"}], "ages": [{"age_min", "age_max", "actors"}]}
+    where an unknown gender or age is null and sorts last
+'''
+
+
+def actor_distributions(movie_id=None):
+    counts = _stored_rollups() if movie_id is None else _cast_rollups(movie_id)
+    genders, ages = Counter(), Counter()
+    for (gender, age_bucket), count in counts.items():
+        genders[gender] += count
+        ages[age_bucket] += count
+
+    return {
+        'total': sum(counts.values()),
+        'genders': [{
+            'gender': None if gender == UNKNOWN_GENDER else gender,
+            'actors': genders[gender]
+        } for gender in sorted(genders, key=lambda gender: _sort_last(gender, UNKNOWN_GENDER))
+            if genders[gender] > 0],
+        'ages': [{
+            'age_min': None if bucket == UNKNOWN_AGE else bucket,
+            'age_max': None if bucket == UNKNOWN_AGE else bucket + AGE_BUCKET_WIDTH - 1,
+            'actors': ages[bucket]
+        } for bucket in sorted(ages, key=lambda bucket: _sort_last(bucket, UNKNOWN_AGE))
+            if ages[bucket] > 0]
+    }